@@ -3,7 +3,20 @@ from firebase_admin import credentials
 from firebase_admin import firestore
 import sys
 import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from models import Town
+from query_engine import (collection_name, versioned_collection_name, DEFAULT_STATE, STATE_NAMES,
+                          POINTER_COLLECTION, POINTER_TTL, DOCUMENTS_LAYOUT, PACKED_LAYOUT, MANIFEST_ID)
+
+# Firestore commits at most 500 writes per batch
+WRITE_BATCH_SIZE = 500
+# How many batches are committed concurrently
+WRITE_WORKERS = 8
+# Towns per chunk document of the packed layout (well under the 1 MiB document limit)
+PACKED_CHUNK_SIZE = 1000
 
 def delete_collection(coll_ref, batch_size):
     if batch_size == 0:
@@ -20,23 +33,152 @@ def delete_collection(coll_ref, batch_size):
         return delete_collection(coll_ref, batch_size)
     print("All documents from collection deleted.")
 
+def write_collection(db, coll_ref, towns):
+    """Writes the towns into a collection, committing batches of
+    WRITE_BATCH_SIZE documents concurrently"""
+    def commit(chunk):
+        batch = db.batch()
+        for town in chunk:
+            batch.set(coll_ref.document(), town.to_dict())
+        batch.commit()
+
+    chunks = [towns[i:i + WRITE_BATCH_SIZE] for i in range(0, len(towns), WRITE_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as pool:
+        # list() re-raises the first failed commit
+        list(pool.map(commit, chunks))
+
+def pack_towns(towns, chunk_size=PACKED_CHUNK_SIZE):
+    """Packs the towns into chunk documents holding one array per field (plus
+    the document id of every town) and a manifest listing the chunks, keyed
+    by document id"""
+    fields = list(Town().to_dict())
+    docs = {}
+    for n, start in enumerate(range(0, len(towns), chunk_size)):
+        rows = [town.to_dict() for town in towns[start:start + chunk_size]]
+        chunk = {"ids": [f"town_{start + i}" for i in range(len(rows))]}
+        chunk.update({f: [row[f] for row in rows] for f in fields})
+        docs[f"chunk_{n:04d}"] = chunk
+    docs[MANIFEST_ID] = {"layout": PACKED_LAYOUT, "chunks": list(docs), "fields": fields, "count": len(towns)}
+    return docs
+
+def write_packed(db, coll_ref, towns):
+    """Writes the packed layout of the towns in a single batch, so readers
+    see every chunk or none"""
+    batch = db.batch()
+    for doc_id, data in pack_towns(towns).items():
+        batch.set(coll_ref.document(doc_id), data)
+    batch.commit()
+
+def count_documents(coll_ref):
+    """Counts the documents of a collection with an aggregation query"""
+    return coll_ref.count().get()[0][0].value
+
+@firestore.transactional
+def reserve_version(transaction, pointer_ref):
+    """Claims the next version number of a state, so concurrent loads never
+    write into the same collection"""
+    snapshot = pointer_ref.get(transaction=transaction)
+    current = snapshot.to_dict() if snapshot.exists else {}
+    version = max(current.get("version", 0), current.get("reserved", 0)) + 1
+    transaction.set(pointer_ref, current | {"reserved": version})
+    return version
+
+@firestore.transactional
+def flip_pointer(transaction, pointer_ref, data):
+    """Points the state at the new collection, unless a load of a newer
+    version already did. Returns the collection it replaced."""
+    snapshot = pointer_ref.get(transaction=transaction)
+    current = snapshot.to_dict() if snapshot.exists else {}
+    if current.get("version", 0) >= data["version"]:
+        raise RuntimeError(f"Version {current['version']} of {pointer_ref.id} is already active")
+    previous = current.get("collection", collection_name(pointer_ref.id))
+    transaction.set(pointer_ref, data | {"previous": previous,
+                                         "reserved": max(current.get("reserved", 0), data["version"])})
+    return previous
+
+def load_version(db, state, towns, layout=DOCUMENTS_LAYOUT):
+    """Loads the towns of a state into a fresh versioned collection, checks
+    that every document arrived and makes it the active collection.
+    With the packed layout, the towns are stored in a few chunk documents.
+    Returns the new and the previous active collection."""
+    pointer_ref = db.collection(POINTER_COLLECTION).document(state)
+    version = reserve_version(db.transaction(), pointer_ref)
+    collection = versioned_collection_name(state, version)
+
+    # the live collection is untouched until the pointer flips, and the
+    # reserved collection belongs to this load alone
+    coll_ref = db.collection(collection)
+    try:
+        if layout == PACKED_LAYOUT:
+            write_packed(db, coll_ref, towns)
+            expected = (len(towns) + PACKED_CHUNK_SIZE - 1) // PACKED_CHUNK_SIZE + 1
+        else:
+            write_collection(db, coll_ref, towns)
+            expected = len(towns)
+        count = count_documents(coll_ref)
+        if count != expected:
+            raise RuntimeError(f"{collection} holds {count} documents, expected {expected}")
+        previous = flip_pointer(db.transaction(), pointer_ref,
+                                {"collection": collection, "version": version, "count": len(towns),
+                                 "layout": layout, "updated": firestore.SERVER_TIMESTAMP})
+    except Exception:
+        delete_collection(coll_ref, WRITE_BATCH_SIZE)
+        raise
+    return collection, previous
+
+def version_of(state, collection):
+    """The version number of one of a state's collections (0 for the
+    unversioned one, None for other collections)"""
+    if collection == collection_name(state):
+        return 0
+    match = re.fullmatch(re.escape(collection_name(state)) + r"_v(\d+)", collection)
+    return int(match.group(1)) if match else None
+
+def collect_garbage(db, state, previous, delay=POINTER_TTL):
+    """Deletes the versions of a state older than `previous`, the version
+    the new one replaced. It first waits `delay` seconds, so readers that
+    cached an older pointer before the flip have refreshed it. The previous
+    version is kept, and newer versions that other loads are still writing
+    are left alone."""
+    time.sleep(delay)
+    keep_from = version_of(state, previous) or 0
+    for coll_ref in db.collections():
+        version = version_of(state, coll_ref.id)
+        if version is not None and version < keep_from:
+            delete_collection(coll_ref, WRITE_BATCH_SIZE)
+            print(f"Deleted old version {coll_ref.id}")
+
 if __name__ == "__main__":
-    # get the data file from program run command
-    data_file = sys.argv[1]
+    # get the data file (and optional state code, VT by default) from program run command;
+    # --packed stores the towns in a few chunk documents instead of one document each
+    args = [a for a in sys.argv[1:] if a != "--packed"]
+    layout = PACKED_LAYOUT if len(args) < len(sys.argv) - 1 else DOCUMENTS_LAYOUT
+    data_file = args[0]
+    state = args[1].upper() if len(args) > 1 else DEFAULT_STATE
+    if state not in STATE_NAMES:
+        print(f"Unknown state '{state}'")
+        sys.exit(1)
     # connect to firestore
     cred = credentials.Certificate("serviceAccountKey.json")
     firebase_admin.initialize_app(cred)
     db=firestore.client()
 
-    # read in the data
+    # read in the data (normalize via model)
     f = open(data_file)
     data = json.load(f)
     f.close()
-    # delete the old data
-    delete_collection(db.collection('Vermont_Municipalities'), len(data))
-    # add the data to the firestore (normalize via model)
-    for idx, item in enumerate(data):
-        town = Town.from_dict(item)
-        db.collection('Vermont_Municipalities').add(town.to_dict())
-        if idx == len(data) - 1:
-            print("Upload successful")
\ No newline at end of file
+    towns = [Town.from_dict(item) for item in data]
+
+    # load a new version next to the live one and switch readers over to it
+    try:
+        collection, previous = load_version(db, state, towns, layout)
+    except RuntimeError as e:
+        print(f"Upload failed: {e}")
+        sys.exit(1)
+    print(f"Upload successful ({collection})")
+
+    # old versions are deleted in the background once every reader's cached
+    # pointer has expired; the script exits once done
+    print(f"Deleting versions older than {previous} in {POINTER_TTL:g}s")
+    gc = threading.Thread(target=collect_garbage, args=(db, state, previous))
+    gc.start()
@@ -0,0 +1,126 @@
+"""Export query results to CSV, Arrow IPC or Parquet files.
+
+Rows are pulled from stream_fn and written in record batches as they
+arrive, so large extracts never hold the full result list in memory.
+Arrow and Parquet output needs the optional pyarrow package.
+"""
+
+import csv
+from dataclasses import fields as dc_fields
+from typing import Iterator, List, Optional
+
+from models import Town, FIELD_TYPES
+from query_engine import QueryPlan, stream_fn
+
+FORMATS = ("csv", "arrow", "parquet")
+
+# File extension -> format, used when no FORMAT is given
+EXTENSIONS = {".csv": "csv", ".arrow": "arrow", ".feather": "arrow", ".ipc": "arrow", ".parquet": "parquet"}
+
+# Rows per record batch in Arrow / Parquet files
+BATCH_SIZE = 1024
+
+
+def format_for(path: str, fmt: Optional[str] = None) -> str:
+    """Picks the export format: the explicit one, else the file extension, else csv"""
+    if fmt:
+        fmt = fmt.lower()
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown export format '{fmt}' (expected csv, arrow or parquet)")
+        return fmt
+    for ext, ext_fmt in EXTENSIONS.items():
+        if path.lower().endswith(ext):
+            return ext_fmt
+    return "csv"
+
+
+def export_columns(plan: QueryPlan) -> List[str]:
+    """The columns written for a plan: the looked up fields for OF lookups,
+    every Town field otherwise, plus the state of each row"""
+    first = plan.filters[0][1]
+    if first.op == "OF":
+        return ["town_name"] + [f for f in (plan.fields or [first.field]) if f != "town_name"] + ["state"]
+    return [f.name for f in dc_fields(Town)] + ["state"]
+
+
+def _coerce(value, column: str):
+    """Casts a value to the type FIELD_TYPES gives its column (None stays None)"""
+    if value is None:
+        return None
+    expected = FIELD_TYPES.get(column, str)
+    try:
+        return expected(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _records(plan: QueryPlan, rows: Iterator[dict], columns: List[str]) -> Iterator[dict]:
+    """Normalizes streamed rows into typed records holding exactly `columns`"""
+    lookup = plan.filters[0][1].op == "OF"
+    for row in rows:
+        # documents are normalized via the model, like the CLI output
+        data = row if lookup else Town.from_dict(row).to_dict() | {"state": row.get("state")}
+        yield {c: _coerce(data.get(c), c) for c in columns}
+
+
+def _batches(records: Iterator[dict], size: int) -> Iterator[List[dict]]:
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _arrow_schema(pa, columns: List[str]):
+    types = {int: pa.int64(), float: pa.float64(), str: pa.string()}
+    return pa.schema([(c, types[FIELD_TYPES.get(c, str)]) for c in columns])
+
+
+def _write_csv(path: str, records: Iterator[dict], columns: List[str]) -> int:
+    count = 0
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+            count += 1
+    return count
+
+
+def _write_arrow(path: str, records: Iterator[dict], columns: List[str], fmt: str) -> int:
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError(f"Exporting to {fmt} needs pyarrow (pip install pyarrow)")
+
+    schema = _arrow_schema(pa, columns)
+    if fmt == "parquet":
+        writer = pa.parquet.ParquetWriter(path, schema)
+    else:
+        writer = pa.ipc.new_file(path, schema)
+
+    count = 0
+    try:
+        for batch in _batches(records, BATCH_SIZE):
+            arrays = [pa.array([r[c] for r in batch], type=schema.field(c).type) for c in columns]
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+            count += len(batch)
+    finally:
+        writer.close()
+    return count
+
+
+def export_fn(db, plan: QueryPlan, path: str, fmt: Optional[str] = None) -> int:
+    """Streams the results of a plan into a CSV, Arrow IPC or Parquet file
+    and returns the number of rows written"""
+    fmt = format_for(path, fmt)
+    columns = export_columns(plan)
+    records = _records(plan, stream_fn(db, plan), columns)
+    if fmt == "csv":
+        return _write_csv(path, records, columns)
+    return _write_arrow(path, records, columns, fmt)
@@ -0,0 +1,260 @@
+"""
+Load test parse_query and run_fn with many concurrent users.
+
+Replays a weighted mix of queries (equality, range, AND, OR, OF and
+invalid ones) either from a fixed number of concurrent users, each sending
+its next query as soon as the last one answered (--concurrency), or at a
+fixed arrival rate (--qps), and reports throughput, p50/p95/p99 latency,
+error rate and documents read per query, overall and per kind of query.
+
+Backends:
+ - local: an in-process LocalFirestore loaded from a JSON data file, with
+   an optional simulated round-trip latency (no network or credentials)
+ - emulator: the Firestore emulator at --emulator-host (loaded from the
+   data file first if its collection is empty)
+ - firestore: the real database, using serviceAccountKey.json like query.py
+
+Examples:
+  python loadtest.py --concurrency 200 --duration 30
+  python loadtest.py --backend emulator --qps 500 --duration 60
+  python loadtest.py --backend local --latency-ms 20 --mix equality=1,of=1
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from parser import parse_query
+from query_engine import execute_plan, collection_name, DEFAULT_STATE
+
+# kind of query -> (weight, queries of that kind); "error" queries are invalid on purpose
+QUERY_MIX = {
+    "equality": (30, ['county == Chittenden', 'county == "Grand Isle"', 'postal_code == 05401',
+                      'town_name == Stowe']),
+    "range": (20, ['population > 10000', 'altitude >= 1200', 'square_mi < 20']),
+    "and": (15, ['altitude < 500 and population > 16000', 'county == Lamoille and population > 2000']),
+    "or": (10, ['county == Essex or county == Orleans', 'population > 15000 or altitude > 1800']),
+    "of": (20, ['altitude OF Burlington', 'population OF "South Burlington"',
+                'altitude, population OF Burlington, Stowe, Barre']),
+    "error": (5, ['population >> 10', 'elevation == 5', 'county == Essex and population > 1 or altitude < 2']),
+}
+
+# percentiles reported for every kind of query
+PERCENTILES = (50, 95, 99)
+
+
+@dataclass
+class Sample:
+    """The outcome of one query"""
+    kind: str
+    latency_ms: float
+    ok: bool
+    docs_read: int = 0
+
+
+@dataclass
+class Report:
+    """Aggregated samples of a run"""
+    duration_s: float
+    samples: List[Sample] = field(default_factory=list)
+
+    def summary(self, kind: Optional[str] = None) -> dict:
+        """Count, throughput, latency percentiles, error rate and mean documents
+        read of the samples of one kind of query (all of them by default)"""
+        samples = [s for s in self.samples if kind is None or s.kind == kind]
+        latencies = sorted(s.latency_ms for s in samples)
+        errors = sum(not s.ok for s in samples)
+        return {
+            "queries": len(samples),
+            "qps": len(samples) / self.duration_s if self.duration_s else 0.0,
+            **{f"p{p}_ms": percentile(latencies, p) for p in PERCENTILES},
+            "error_rate": errors / len(samples) if samples else 0.0,
+            "docs_per_query": sum(s.docs_read for s in samples) / len(samples) if samples else 0.0,
+        }
+
+    def kinds(self) -> List[str]:
+        """The kinds of query that were sent, in QUERY_MIX order"""
+        sent = {s.kind for s in self.samples}
+        return [k for k in QUERY_MIX if k in sent]
+
+    def lines(self) -> List[str]:
+        """The report as a table, one row per kind of query and a total"""
+        header = f"{'kind':<10}{'queries':>9}{'qps':>9}" + "".join(f"{'p' + str(p) + ' ms':>10}" for p in PERCENTILES)
+        header += f"{'errors':>9}{'docs/q':>9}"
+        lines = [header]
+        for kind in self.kinds() + [None]:
+            s = self.summary(kind)
+            lines.append(f"{kind or 'total':<10}{s['queries']:>9}{s['qps']:>9.1f}"
+                         + "".join(f"{s[f'p{p}_ms']:>10.1f}" for p in PERCENTILES)
+                         + f"{s['error_rate']:>9.1%}{s['docs_per_query']:>9.1f}")
+        return lines
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest-rank percentile of already sorted values (0 when empty)"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def parse_mix(text: str) -> Dict[str, int]:
+    """Parses weight overrides like "equality=50,of=10" (other kinds get 0)"""
+    weights = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip().lower()
+        if kind not in QUERY_MIX:
+            raise ValueError(f"Unknown kind of query '{kind}' (expected {', '.join(QUERY_MIX)})")
+        weights[kind] = int(weight)
+    return weights
+
+
+def pick_queries(count: int, weights: Dict[str, int], seed: Optional[int] = None) -> List[Tuple[str, str]]:
+    """Draws (kind, query text) pairs following the weights of the mix"""
+    rng = random.Random(seed)
+    kinds = [k for k in QUERY_MIX if weights.get(k, 0) > 0]
+    if not kinds:
+        raise ValueError("The query mix has no positive weight")
+    drawn = rng.choices(kinds, weights=[weights[k] for k in kinds], k=count)
+    return [(kind, rng.choice(QUERY_MIX[kind][1])) for kind in drawn]
+
+
+def run_query(db, kind: str, text: str, started: Optional[float] = None) -> Sample:
+    """Parses and runs one query the way query.py does. Latency counts from
+    `started` when given (the time the query was due), so a backlog of
+    queued queries shows up in the percentiles."""
+    start = started if started is not None else time.perf_counter()
+    docs_read = 0
+    try:
+        plan = parse_query(text)
+        ok = not isinstance(plan, str)
+        if ok:
+            _, steps = execute_plan(db, plan)
+            docs_read = sum(step.stats.docs_read for step in steps if step.stats is not None)
+    except Exception:
+        ok = False
+    return Sample(kind, (time.perf_counter() - start) * 1000, ok, docs_read)
+
+
+def run_closed(db, weights: Dict[str, int], concurrency: int, duration_s: float,
+               seed: Optional[int] = None) -> Report:
+    """Runs `concurrency` users, each sending its next query as soon as the
+    previous one answered, for duration_s seconds"""
+    samples = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration_s
+
+    def user(n: int):
+        rng_seed = None if seed is None else seed + n
+        mine = []
+        while time.perf_counter() < deadline:
+            for kind, text in pick_queries(16, weights, rng_seed):
+                mine.append(run_query(db, kind, text))
+                if time.perf_counter() >= deadline:
+                    break
+            rng_seed = None if rng_seed is None else rng_seed + concurrency
+        with lock:
+            samples.extend(mine)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=user, args=(n,)) for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return Report(time.perf_counter() - start, samples)
+
+
+def run_open(db, weights: Dict[str, int], qps: float, duration_s: float, max_in_flight: int,
+             seed: Optional[int] = None) -> Report:
+    """Sends queries at a fixed rate of `qps` for duration_s seconds, with at
+    most max_in_flight of them running at once. Queries that wait for a free
+    worker count their wait in their latency."""
+    queries = pick_queries(max(1, int(qps * duration_s)), weights, seed)
+    interval = 1.0 / qps
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        futures = []
+        for n, (kind, text) in enumerate(queries):
+            due = start + n * interval
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(run_query, db, kind, text, due))
+        samples = [f.result() for f in futures]
+    return Report(time.perf_counter() - start, samples)
+
+
+def connect(args):
+    """Returns the database client of the chosen backend"""
+    if args.backend == "local":
+        from local_db import LocalFirestore
+        return LocalFirestore.from_json(args.data, latency_ms=args.latency_ms)
+    if args.backend == "emulator":
+        os.environ["FIRESTORE_EMULATOR_HOST"] = args.emulator_host
+        from google.cloud import firestore
+        db = firestore.Client(project=args.project)
+        if not list(db.collection(collection_name(DEFAULT_STATE)).limit(1).stream()):
+            seed_emulator(db, args.data)
+        return db
+    from query import ensure_firestore
+    return ensure_firestore()
+
+
+def seed_emulator(db, data_file: str):
+    """Loads the data file into an empty emulator like admin.py would"""
+    from admin import write_collection
+    from models import Town
+    with open(data_file) as f:
+        towns = [Town.from_dict(item) for item in json.load(f)]
+    write_collection(db, db.collection(collection_name(DEFAULT_STATE)), towns)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Load test parse_query and run_fn")
+    ap.add_argument("--backend", choices=("local", "emulator", "firestore"), default="local")
+    load = ap.add_mutually_exclusive_group()
+    load.add_argument("--concurrency", type=int, default=50, help="concurrent users (default 50)")
+    load.add_argument("--qps", type=float, help="send queries at this rate instead")
+    ap.add_argument("--max-in-flight", type=int, default=256, help="most concurrent queries with --qps")
+    ap.add_argument("--duration", type=float, default=10.0, help="seconds to run (default 10)")
+    ap.add_argument("--mix", help='weights like "equality=50,of=10" (default: QUERY_MIX)')
+    ap.add_argument("--seed", type=int, help="seed the query mix to replay the same sequence")
+    ap.add_argument("--data", default="Vermont_Muni.json", help="data file of the local/emulator backends")
+    ap.add_argument("--latency-ms", type=float, default=0.0, help="simulated round trip of the local backend")
+    ap.add_argument("--emulator-host", default="localhost:8080")
+    ap.add_argument("--project", default="vermont-muni", help="project id used with the emulator")
+    ap.add_argument("--json", help="also write the summaries to this JSON file")
+    args = ap.parse_args(argv)
+
+    try:
+        weights = parse_mix(args.mix) if args.mix else {k: w for k, (w, _) in QUERY_MIX.items()}
+        db = connect(args)
+    except Exception as e:
+        print(f"Load test setup failed: {e}")
+        return 1
+
+    if args.qps:
+        print(f"Sending {args.qps:g} queries/s for {args.duration:g}s against {args.backend}")
+        report = run_open(db, weights, args.qps, args.duration, args.max_in_flight, args.seed)
+    else:
+        print(f"Running {args.concurrency} concurrent users for {args.duration:g}s against {args.backend}")
+        report = run_closed(db, weights, args.concurrency, args.duration, args.seed)
+
+    print("\n".join(report.lines()))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({kind or "total": report.summary(kind) for kind in report.kinds() + [None]}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,46 @@
+from loadtest import run_closed, run_open, percentile, parse_mix, QUERY_MIX
+from local_db import LocalFirestore
+
+'''
+test_one checks the nearest-rank percentiles the report uses
+'''
+def test_one():
+    values = [float(v) for v in range(1, 101)]
+    if percentile(values, 50) == 50 and percentile(values, 99) == 99 and percentile([], 95) == 0:
+        print("PASSED TEST ONE")
+        return
+    print("FAILED TEST ONE")
+
+'''
+test_two runs 8 concurrent users against the in-process backend and checks
+that every kind of query was sent, that only the invalid ones failed and
+that valid queries read documents
+'''
+def test_two():
+    db = LocalFirestore.from_json("Vermont_Muni.json")
+    weights = {k: w for k, (w, _) in QUERY_MIX.items()}
+    report = run_closed(db, weights, concurrency=8, duration_s=1, seed=7)
+    ok = {k: report.summary(k) for k in report.kinds()}
+    if (set(ok) == set(QUERY_MIX)
+            and ok["error"]["error_rate"] == 1
+            and all(s["error_rate"] == 0 and s["docs_per_query"] > 0 for k, s in ok.items() if k != "error")):
+        print("PASSED TEST TWO")
+        return
+    print("FAILED TEST TWO")
+
+'''
+test_three checks that a fixed-rate run of OF queries sends the requested
+number of queries
+'''
+def test_three():
+    db = LocalFirestore.from_json("Vermont_Muni.json")
+    report = run_open(db, parse_mix("of=1"), qps=50, duration_s=1, max_in_flight=4)
+    if len(report.samples) == 50 and report.kinds() == ["of"] and report.summary()["error_rate"] == 0:
+        print("PASSED TEST THREE")
+        return
+    print("FAILED TEST THREE")
+
+if __name__ == "__main__":
+    test_one()
+    test_two()
+    test_three()
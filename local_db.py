@@ -0,0 +1,293 @@
+"""
+An in-process stand-in for the Firestore client, used by loadtest.py to
+exercise parse_query and run_fn without a network or credentials.
+
+LocalFirestore holds collections of documents in memory and serves the
+subset of the client API query_engine uses: collection(), where(filter=
+FieldFilter), order_by(), limit(), select(), stream(), document().get(),
+get_all(), collections() and on_snapshot() on queries and documents (which
+calls back synchronously, on the writing thread). Like a Firestore database with no composite
+indexes, it rejects queries that would need one, and it can add a fixed
+round-trip latency to every read. It counts the documents it returns so
+a load test can report the reads a real database would bill.
+"""
+
+import json
+import threading
+import time
+import uuid
+from enum import Enum
+from typing import Callable, List, Optional
+
+from models import Town
+from query_engine import PREDICATE_OPS, collection_name
+
+# Firestore operator -> QueryPlan operator, to reuse the engine's predicates
+_OPS = {"in": "IN", "not-in": "NOT IN"}
+
+
+class LocalSnapshot:
+    """A document snapshot: id, exists and to_dict() like Firestore's"""
+
+    def __init__(self, doc_id: str, data: Optional[dict]):
+        self.id = doc_id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> Optional[dict]:
+        return None if self._data is None else dict(self._data)
+
+
+class ChangeType(Enum):
+    """The kind of a DocumentChange, named like Firestore's"""
+    ADDED = 0
+    MODIFIED = 1
+    REMOVED = 2
+
+
+class LocalChange:
+    """A document change delivered to a query's snapshot listener"""
+
+    def __init__(self, type: ChangeType, document: LocalSnapshot):
+        self.type = type
+        self.document = document
+
+
+class LocalWatch:
+    """A snapshot listener, called back with (documents, changes, read time)
+    on every write to its collection that changes what it sees"""
+
+    def __init__(self, db, collection: str, snapshot: Callable[[], dict], callback: Callable):
+        self._db = db
+        self.collection = collection
+        self._snapshot = snapshot
+        self._callback = callback
+        self._seen = {}
+        self._fired = False
+
+    def refresh(self):
+        docs = self._snapshot()
+        changes = [LocalChange(ChangeType.REMOVED, LocalSnapshot(doc_id, data))
+                   for doc_id, data in self._seen.items() if doc_id not in docs]
+        for doc_id, data in docs.items():
+            if doc_id not in self._seen:
+                changes.append(LocalChange(ChangeType.ADDED, LocalSnapshot(doc_id, data)))
+            elif self._seen[doc_id] != data:
+                changes.append(LocalChange(ChangeType.MODIFIED, LocalSnapshot(doc_id, data)))
+        if self._fired and not changes:
+            return
+        # like Firestore, the first snapshot is delivered even when empty
+        self._fired = True
+        self._seen = docs
+        self._db.count_reads(len(changes))
+        self._callback([LocalSnapshot(doc_id, data) for doc_id, data in docs.items()], changes, None)
+
+    def unsubscribe(self):
+        self._db.stop_watch(self)
+
+
+class LocalQuery:
+    """An immutable query on a LocalFirestore collection"""
+
+    def __init__(self, db, name: str, filters=(), orders=(), limit_to=None, fields=None):
+        self._db = db
+        self._name = name
+        self._filters = list(filters)
+        self._orders = list(orders)
+        self._limit = limit_to
+        self._fields = fields
+
+    def _copy(self, **changes) -> "LocalQuery":
+        state = dict(filters=self._filters, orders=self._orders, limit_to=self._limit, fields=self._fields)
+        state.update(changes)
+        return LocalQuery(self._db, self._name, **state)
+
+    def where(self, filter=None) -> "LocalQuery":
+        return self._copy(filters=self._filters + [filter])
+
+    def order_by(self, field_path: str, direction: str = "ASCENDING") -> "LocalQuery":
+        return self._copy(orders=self._orders + [(field_path, direction)])
+
+    def limit(self, count: int) -> "LocalQuery":
+        return self._copy(limit_to=count)
+
+    def select(self, field_paths) -> "LocalQuery":
+        return self._copy(fields=list(field_paths))
+
+    def stream(self, **kwargs):
+        self._check_indexes()
+        self._db.round_trip()
+        matches = self._matching()
+        self._db.count_reads(len(matches))
+        for doc_id, data in matches.items():
+            yield LocalSnapshot(doc_id, data)
+
+    def get(self, **kwargs) -> List[LocalSnapshot]:
+        return list(self.stream())
+
+    def on_snapshot(self, callback: Callable) -> LocalWatch:
+        self._check_indexes()
+        return self._db.start_watch(LocalWatch(self._db, self._name, self._matching, callback))
+
+    def _matching(self) -> dict:
+        """The documents the query returns, by id, without counting reads"""
+        docs = self._db.documents(self._name)
+        matches = [(doc_id, data) for doc_id, data in list(docs.items())
+                   if all(_matches(f, data) for f in self._filters)]
+        for field_path, direction in reversed(self._orders):
+            matches = [m for m in matches if m[1].get(field_path) is not None]
+            matches.sort(key=lambda m: m[1][field_path], reverse=(direction == "DESCENDING"))
+        if self._limit is not None:
+            matches = matches[:self._limit]
+        if self._fields is not None:
+            matches = [(doc_id, {k: data[k] for k in self._fields if k in data}) for doc_id, data in matches]
+        return {doc_id: dict(data) for doc_id, data in matches}
+
+    def _check_indexes(self):
+        """Raises like Firestore for queries its single-field indexes cannot serve"""
+        equality = {f.field_path for f in self._filters if f.op_string in ("==", "in")}
+        inequality = {f.field_path for f in self._filters if f.op_string not in ("==", "in")}
+        ordered = {field_path for field_path, _ in self._orders}
+        if (len(inequality) > 1
+                or (equality and (inequality or ordered - equality))
+                or (inequality and ordered - inequality)):
+            raise RuntimeError("400 The query requires an index (LocalFirestore has no composite indexes)")
+
+
+class LocalDocument:
+    """A reference to one document of a LocalFirestore collection"""
+
+    def __init__(self, db, collection: str, doc_id: str):
+        self._db = db
+        self._collection = collection
+        self.id = doc_id
+
+    def get(self, **kwargs) -> LocalSnapshot:
+        self._db.round_trip()
+        self._db.count_reads(1)
+        return LocalSnapshot(self.id, self._db.documents(self._collection).get(self.id))
+
+    def set(self, data: dict, merge: bool = False):
+        self._db.documents(self._collection, create=True)[self.id] = dict(data)
+        self._db.notify(self._collection)
+
+    def delete(self):
+        self._db.documents(self._collection).pop(self.id, None)
+        self._db.notify(self._collection)
+
+    def on_snapshot(self, callback: Callable) -> LocalWatch:
+        def snapshot():
+            data = self._db.documents(self._collection).get(self.id)
+            return {} if data is None else {self.id: dict(data)}
+
+        def on_document(docs, changes, read_time):
+            callback(docs or [LocalSnapshot(self.id, None)], changes, read_time)
+        return self._db.start_watch(LocalWatch(self._db, self._collection, snapshot, on_document))
+
+
+class LocalCollection(LocalQuery):
+    """A collection of a LocalFirestore; also the query returning all of it"""
+
+    def __init__(self, db, name: str):
+        super().__init__(db, name)
+        self.id = name
+
+    def document(self, doc_id: Optional[str] = None) -> LocalDocument:
+        return LocalDocument(self._db, self._name, doc_id or uuid.uuid4().hex[:20])
+
+    def add(self, data: dict):
+        ref = self.document()
+        ref.set(data)
+        return None, ref
+
+
+class LocalFirestore:
+    """
+    An in-memory Firestore client
+
+    Attributes:
+     - latency_ms (float): round-trip latency added to every query and document read
+     - docs_read (int): documents returned so far, as Firestore would bill them
+       (a query returning nothing still costs one read)
+    """
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.docs_read = 0
+        self._collections = {}
+        self._watches = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_json(cls, path: str, state: str = "VT", latency_ms: float = 0.0) -> "LocalFirestore":
+        """A database holding the towns of a JSON data file (as admin.py loads them)"""
+        db = cls(latency_ms)
+        with open(path) as f:
+            data = json.load(f)
+        towns = db.collection(collection_name(state))
+        for item in data:
+            towns.add(Town.from_dict(item).to_dict())
+        return db
+
+    def collection(self, name: str) -> LocalCollection:
+        return LocalCollection(self, name)
+
+    def collections(self) -> List[LocalCollection]:
+        self.round_trip()
+        return [LocalCollection(self, name) for name, docs in list(self._collections.items()) if docs]
+
+    def get_all(self, references, **kwargs):
+        references = list(references)
+        self.round_trip()
+        self.count_reads(len(references))
+        for ref in references:
+            yield LocalSnapshot(ref.id, self.documents(ref._collection).get(ref.id))
+
+    def documents(self, name: str, create: bool = False) -> dict:
+        """The documents of a collection, by id"""
+        if create:
+            with self._lock:
+                return self._collections.setdefault(name, {})
+        return self._collections.get(name, {})
+
+    def start_watch(self, watch: LocalWatch) -> LocalWatch:
+        """Registers a snapshot listener and delivers its first snapshot"""
+        with self._lock:
+            self._watches.append(watch)
+        watch.refresh()
+        return watch
+
+    def stop_watch(self, watch: LocalWatch):
+        with self._lock:
+            if watch in self._watches:
+                self._watches.remove(watch)
+
+    def notify(self, collection: str):
+        """Calls back the listeners of a collection after a write"""
+        with self._lock:
+            watches = [w for w in self._watches if w.collection == collection]
+        for watch in watches:
+            with self._lock:
+                active = watch in self._watches
+            if active:
+                watch.refresh()
+
+    def round_trip(self):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def count_reads(self, count: int):
+        with self._lock:
+            self.docs_read += max(count, 1)
+
+
+def _matches(f, data: dict) -> bool:
+    """Evaluates a FieldFilter on a document the way Firestore does: documents
+    missing the field never match"""
+    value = data.get(f.field_path)
+    if value is None:
+        return False
+    try:
+        return PREDICATE_OPS[_OPS.get(f.op_string, f.op_string)](value, f.value)
+    except TypeError:  # Firestore never matches values of another type
+        return False
@@ -2,6 +2,20 @@ from dataclasses import dataclass
 from typing import Any, Dict, Optional
 import re
 
+# Queryable fields and the Python type of their values
+FIELD_TYPES = {
+    "town_id": int,
+    "population": int,
+    "county": str,
+    "square_mi": float,
+    "altitude": int,
+    "postal_code": str,
+    "office_phone": str,
+    "clerk_email": str,
+    "url": str,
+    "town_name": str
+}
+
 
 @dataclass
 class Town:
@@ -1,7 +1,8 @@
 import re
 
 import pyparsing as pp
-from query_engine import QueryPlan, Filter
+from query_engine import QueryPlan, Filter, STATE_NAMES, ALL_STATES
+from models import FIELD_TYPES
 
 pp.ParserElement.enablePackrat()
 
@@ -19,6 +20,8 @@ word = pp.Word(pp.alphanums + "_.'- @:/")  # alphanumeric word with common punct
 NUM_OP = pp.oneOf("< > <= >=")
 EQ_OP = pp.oneOf("== !=")
 OF_OP = pp.CaselessKeyword("OF")
+SET_OP = pp.Combine(pp.Optional(pp.CaselessKeyword("NOT") + pp.White(" ")) + pp.CaselessKeyword("IN"), adjacent=False)
+SET_OP.addParseAction(lambda t: "NOT IN" if t[0].upper().startswith("NOT") else "IN")
 
 # Values
 # boolean keywords
@@ -55,20 +58,10 @@ Accepted fields:
 - clerk_email -> str -> clerk_email
 - url -> str -> url
 - town_name -> str -> town_name
+
+The field -> type map is FIELD_TYPES in models.py (shared with query_engine).
 """
 
-FIELD_TYPES = {
-    "town_id": int,
-    "population": int,
-    "county": str,
-    "square_mi": float,
-    "altitude": int,
-    "postal_code": str,
-    "office_phone": str,
-    "clerk_email": str,
-    "url": str,
-    "town_name": str
-}
 
 
 def validate(tree):
@@ -84,11 +77,9 @@ def _validate_expr(node, errors):
         for child in node:
             _validate_expr(child, errors)
 
-def _atom_to_dict(tokens):
-    t = tokens[0]
-    val = t.value
+def _normalize_value(field, val):
     # Capitalize first letter of each word for all string fields
-    if isinstance(val, str) and t.field in FIELD_TYPES and FIELD_TYPES[t.field] is str:
+    if isinstance(val, str) and field in FIELD_TYPES and FIELD_TYPES[field] is str:
         val = " ".join(word.capitalize() for word in val.split())
 
     # Normaliza a string si llega como ParseResults/lista
@@ -99,7 +90,7 @@ def _atom_to_dict(tokens):
             val = " ".join(map(str, val.asList()))
 
     # For numeric fields (except postal_code), try int first, then float
-    if t.field != "postal_code" and isinstance(val, str):
+    if field != "postal_code" and isinstance(val, str):
         try:
             # first try integer
             val = int(val)
@@ -110,17 +101,40 @@ def _atom_to_dict(tokens):
             except ValueError:
                 pass  # leave it as string if neither works
 
-    return {"field": t.field, "op": str(t.op), "value": val}
+    return val
+
+def _atom_to_dict(tokens):
+    t = tokens[0]
+    field = t.field
+    val = t.value
+    if "towns" in t:
+        # "field[, field ...] OF town[, town ...]"
+        fields = list(dict.fromkeys(t.fields))
+        field = fields[0]
+        if len(fields) > 1 or len(t.towns) > 1:
+            # Bulk lookup: town names are matched as stored (capitalized)
+            towns = [" ".join(word.capitalize() for word in town.split()) for town in t.towns]
+            return {"field": field, "op": "OF", "value": towns, "fields": fields}
+        val = t.towns[0]
+
+    if "members" in t:
+        # "field IN (v1, v2, ...)" / "field NOT IN (...)": normalize every value
+        values = [_normalize_value(field, v) for v in t.members]
+        return {"field": field, "op": str(t.op), "value": list(dict.fromkeys(values))}
+
+    return {"field": field, "op": str(t.op), "value": _normalize_value(field, val)}
 
 # keep your STRING_TOKEN as you already have (doesn't swallow AND/OR)
 
 VAL_NUMOP = (number | STRING_TOKEN).setName("num_compare_value")  # number FIRST
 VAL_EQ = (PHONE_DASHED | PHONE_PLAIN | number | STRING_TOKEN).setName("eq_value")
+VAL_LIST = pp.Suppress("(") + pp.delimitedList(VAL_EQ) + pp.Suppress(")")
 
 atom = pp.Group(
     (FIELD("field") + NUM_OP("op") + VAL_NUMOP("value")) |
     (FIELD("field") + EQ_OP("op") + VAL_EQ("value")) |
-    (FIELD("field") + OF_OP("op") + STRING_TOKEN("value"))
+    (FIELD("field") + SET_OP("op") + pp.Group(VAL_LIST)("members")) |
+    (pp.Group(pp.delimitedList(FIELD))("fields") + OF_OP("op") + pp.Group(pp.delimitedList(STRING_TOKEN))("towns"))
 ).setParseAction(_atom_to_dict)
 
 # AND has higher precedence than OR
@@ -132,6 +146,28 @@ expr = pp.infixNotation(
     ],
 )
 
+# Optional clauses after the conditions:
+#   IN STATES VT, NH, ME | IN ALL STATES    (which state collections to query)
+#   ORDER BY field [ASC|DESC]
+#   LIMIT n
+STATE_CODE = pp.Word(pp.alphas, exact=2).setName("state code").addParseAction(lambda t: t[0].upper())
+ALL_KW = pp.CaselessKeyword("all").addParseAction(lambda t: ALL_STATES)
+STATES_KW = pp.CaselessKeyword("states")
+SCOPE = pp.Suppress(pp.CaselessKeyword("in")) + (
+    (pp.Suppress(STATES_KW) + (ALL_KW | pp.delimitedList(STATE_CODE))) |
+    (ALL_KW + pp.Suppress(pp.Optional(STATES_KW)))
+)
+ORDER = (pp.Suppress(pp.CaselessKeyword("order") + pp.CaselessKeyword("by")) + FIELD +
+         pp.Optional(pp.oneOf("asc desc", caseless=True), default="asc").addParseAction(lambda t: t[0].upper()))
+LIMIT = pp.Suppress(pp.CaselessKeyword("limit")) + pp.pyparsing_common.integer
+
+CLAUSES = (pp.Optional(pp.Group(SCOPE)("scope")) +
+           pp.Optional(pp.Group(ORDER)("order")) +
+           pp.Optional(pp.Group(LIMIT)("limit")))
+
+# Where the optional clauses start (outside of quoted values)
+CLAUSE_START = re.compile(r"\s(?:in\s+(?:states|all)\b|order\s+by\b|limit\b)", re.IGNORECASE)
+
 # Semantic validation
 
 IDENT = pp.Word(pp.alphas, pp.alphanums + "_")  # for first-token sniffing
@@ -156,6 +192,23 @@ def _validate_atom(atom_dict, errors):
         if not isinstance(value, (int, float)):
             errors.append(f"Field '{field}' expects a number, got '{value}'")
 
+    if op in ("IN", "NOT IN"):
+        # Set membership: every value must be valid for an equality on the field,
+        # and keeps the normalization (postal codes, phone numbers) that == applies
+        normalized = []
+        for v in value:
+            item = {"field": field, "op": "==", "value": v}
+            _validate_atom(item, errors)
+            normalized.append(item["value"])
+        atom_dict["value"] = list(dict.fromkeys(normalized))
+        return
+
+    if op.upper() == "OF" and isinstance(value, list):
+        # Bulk lookup: every town name must be valid on its own
+        for town in value:
+            _validate_atom({"field": field, "op": op, "value": town}, errors)
+        return
+
     if op.upper() == "OF":
         if not isinstance(value, str):
             errors.append(f"Operator 'OF' with field '{field}' expects a string, got {value}")
@@ -235,15 +288,64 @@ def _first_token(s: str) -> str:
     except pp.ParseBaseException:
         return None
 
-def _convert_to_query_plan(parsed_result) -> QueryPlan:
-    """Convert parsed result to QueryPlan object."""
+def _quoted_spans(s: str):
+    """The (start, end) of every quoted value. A quote only opens a value at the
+    start of a token, so apostrophes inside words (Warren's) are plain text,
+    as in the grammar, and a quote of the other kind inside a quoted value
+    ("Avery's Gore") does not close it."""
+    spans = []
+    open_at = None
+    for i, ch in enumerate(s):
+        if open_at is not None:
+            if ch == s[open_at]:
+                spans.append((open_at, i))
+                open_at = None
+        elif ch in "\"'" and (i == 0 or not (s[i - 1].isalnum() or s[i - 1] in "._'-@:/")):
+            open_at = i
+    if open_at is not None:
+        spans.append((open_at, len(s)))
+    return spans
+
+def _split_clauses(s: str):
+    """Splits a query into its conditions and the trailing IN/ORDER BY/LIMIT clauses.
+    A keyword only starts the clauses when the rest of the query parses as
+    clauses, so values such as `town_name == Limit` stay conditions."""
+    spans = _quoted_spans(s)
+    starts = [m.start() for m in CLAUSE_START.finditer(s)
+              if not any(start < m.start() <= end for start, end in spans)]
+    for start in starts:
+        try:
+            CLAUSES.parseString(s[start:], parseAll=True)
+        except pp.ParseException:
+            continue
+        return s[:start].strip(), s[start:].strip()
+    if starts:
+        try:
+            expr.parseString(s, parseAll=True)
+        except pp.ParseException:
+            # a malformed clause is reported as one
+            return s[:starts[0]].strip(), s[starts[0]:].strip()
+    return s, ""
+
+def _validate_clauses(parsed, errors):
+    for code in parsed["scope"] if "scope" in parsed else []:
+        if code != ALL_STATES and code not in STATE_NAMES:
+            errors.append(f"Unknown state '{code}'")
+    if "limit" in parsed and parsed["limit"][0] < 1:
+        errors.append("LIMIT must be a positive number")
+
+def _convert_to_query_plan(parsed_result, clauses=None) -> QueryPlan:
+    """Convert parsed result (and the optional IN/ORDER BY/LIMIT clauses) to QueryPlan object."""
     filters = []
+    fields = []
     
     def process_node(node, connector=""):
         if isinstance(node, dict):
             # Single condition: {'field': 'county', 'op': '==', 'value': 'Chittenden'}
             filter_obj = Filter(field=node['field'], op=node['op'], value=node['value'])
             filters.append((connector, filter_obj))
+            # Bulk OF lookups also carry every requested field
+            fields.extend(node.get('fields', []))
         elif isinstance(node, list):
             # Compound query: [condition1, 'and', condition2]
             if len(node) == 3 and node[1] in ['and', 'or']:
@@ -254,10 +356,19 @@ def _convert_to_query_plan(parsed_result) -> QueryPlan:
                 process_node(node[0], connector)
     
     process_node(parsed_result)
-    return QueryPlan(filters=filters)
+    plan = QueryPlan(filters=filters, fields=fields)
+    if clauses is not None:
+        if "scope" in clauses:
+            codes = list(clauses["scope"])
+            plan.scope = [ALL_STATES] if ALL_STATES in codes else list(dict.fromkeys(codes))
+        if "order" in clauses:
+            plan.order_by = tuple(clauses["order"])
+        if "limit" in clauses:
+            plan.limit = clauses["limit"][0]
+    return plan
 
 def parse_query(s: str):
-    s = s.strip()
+    s, clause_text = _split_clauses(s.strip())
 
     # Check for using more than 2 compound queries at once
     if s.upper().count(" AND ") > 1 or s.upper().count(" OR ") > 1 or (" AND " in s.upper() and " OR " in s.upper()):
@@ -274,15 +385,23 @@ def parse_query(s: str):
     try:
         parsed = expr.parseString(s, parseAll=True).asList()
         errors = validate(parsed)
+        try:
+            clauses = CLAUSES.parseString(clause_text, parseAll=True)
+        except pp.ParseException as ce:
+            return f"Invalid query: Bad IN STATES/ORDER BY/LIMIT clause. {ce}"
+        _validate_clauses(clauses, errors)
         if errors:
             return "Invalid query: " + "; ".join(errors)
-        return _convert_to_query_plan(parsed)
+        if "order" in clauses or "limit" in clauses:
+            if isinstance(parsed[0], dict) and parsed[0]["op"].upper() == "OF":
+                return "Invalid query: ORDER BY and LIMIT cannot be used with OF"
+        return _convert_to_query_plan(parsed, clauses)
     except pp.ParseException as pe:
         err_text = str(pe)
 
         # Handle invalid characters in OF queries
-        if " of " in s.lower() and (";" in s or ":" in s or "!" in s or "@" in s or "#" in s or "$" in s or "%" in s or "^" in s or "&" in s or "*" in s or "(" in s or ")" in s or "+" in s or "=" in s or "[" in s or "]" in s or "{" in s or "}" in s or "|" in s or "\\" in s or "/" in s or "<" in s or ">" in s or "," in s or "?" in s):
-            return "Invalid query: Town names cannot contain special characters like ; : ! @ # $ % ^ & * ( ) + = [ ] { } | \\ / < > , ?"
+        if " of " in s.lower() and (";" in s or ":" in s or "!" in s or "@" in s or "#" in s or "$" in s or "%" in s or "^" in s or "&" in s or "*" in s or "(" in s or ")" in s or "+" in s or "=" in s or "[" in s or "]" in s or "{" in s or "}" in s or "|" in s or "\\" in s or "/" in s or "<" in s or ">" in s or "?" in s):
+            return "Invalid query: Town names cannot contain special characters like ; : ! @ # $ % ^ & * ( ) + = [ ] { } | \\ / < > ?"
         
         # Handle double operators first (AND AND, OR OR)
         if " and and " in s.lower() or " or or " in s.lower() or " and and" in s.lower() or " or or" in s.lower():
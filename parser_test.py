@@ -87,6 +87,79 @@ def test_parse_query_eight():
         return
     print("FAILED TEST EIGHT: parse_query(), incomplete query")
 
+'''
+test 9 ensures that the IN STATES / ORDER BY / LIMIT clauses end up in the QueryPlan
+'''
+def test_parse_query_nine():
+    query = "population > 10000 IN STATES vt, NH ORDER BY population DESC LIMIT 5"
+    query_plan = QueryPlan(filters=[("", Filter("population", ">", 10000))],
+                           scope=["VT", "NH"], order_by=("population", "DESC"), limit=5)
+    if parse_query(query) == query_plan:
+        print("PASSED TEST NINE: parse_query(), scope, order and limit clauses")
+        return
+    print("FAILED TEST NINE: parse_query(), scope, order and limit clauses")
+
+'''
+test 10 ensures that unknown states are rejected and ALL selects every state
+'''
+def test_parse_query_ten():
+    all_plan = QueryPlan(filters=[("", Filter("county", "==", "Essex"))], scope=["ALL"])
+    if parse_query("county == Essex IN STATES XX") == "Invalid query: Unknown state 'XX'" \
+        and parse_query("county == Essex IN ALL STATES") == all_plan:
+        print("PASSED TEST TEN: parse_query(), state scope")
+        return
+    print("FAILED TEST TEN: parse_query(), state scope")
+
+'''
+test 11 ensures that several fields and towns around OF become one bulk lookup
+'''
+def test_parse_query_eleven():
+    query = "altitude, population OF Burlington, stowe, \"south burlington\""
+    query_plan = QueryPlan(filters=[("", Filter("altitude", "OF", ["Burlington", "Stowe", "South Burlington"]))],
+                           fields=["altitude", "population"])
+    if parse_query(query) == query_plan:
+        print("PASSED TEST ELEVEN: parse_query(), bulk OF lookup")
+        return
+    print("FAILED TEST ELEVEN: parse_query(), bulk OF lookup")
+
+'''
+test 12 ensures that IN / NOT IN parse into a list of normalized values
+'''
+def test_parse_query_twelve():
+    in_plan = QueryPlan(filters=[("", Filter("county", "IN", ["Essex", "Orleans", "Caledonia"]))])
+    not_in_plan = QueryPlan(filters=[("", Filter("postal_code", "NOT IN", ["05401", "05402"]))])
+    if parse_query("county IN (\"Essex\", \"Orleans\", caledonia)") == in_plan \
+        and parse_query("postal_code not in (5401, 05402)") == not_in_plan:
+        print("PASSED TEST TWELVE: parse_query(), IN / NOT IN")
+        return
+    print("FAILED TEST TWELVE: parse_query(), IN / NOT IN")
+
+def test_parse_query_thirteen():
+    avery = QueryPlan(filters=[("", Filter("population", "OF", "Avery's Gore"))], scope=["VT"])
+    buel = QueryPlan(filters=[("", Filter("altitude", "OF", ["Buel's Gore", "Stowe"]))], scope=["ALL"],
+                     fields=["altitude", "population"])
+    warren = QueryPlan(filters=[("", Filter("town_name", "==", "Warren's"))], limit=3)
+    quoted = QueryPlan(filters=[("", Filter("county", "==", "Essex Limit 3"))])
+    if parse_query('population OF "Avery\'s Gore" IN STATES VT') == avery \
+        and parse_query('altitude, population OF "Buel\'s Gore", Stowe IN ALL STATES') == buel \
+        and parse_query("town_name == Warren's LIMIT 3") == warren \
+        and parse_query('county == "Essex limit 3"') == quoted:
+        print("PASSED TEST THIRTEEN: parse_query(), apostrophes before IN STATES/LIMIT")
+        return
+    print("FAILED TEST THIRTEEN: parse_query(), apostrophes before IN STATES/LIMIT")
+
+def test_parse_query_fourteen():
+    limit = QueryPlan(filters=[("", Filter("town_name", "==", "Limit"))])
+    limited = QueryPlan(filters=[("", Filter("county", "==", "Order"))], limit=2)
+    either = QueryPlan(filters=[("", Filter("town_name", "==", "Limit")), ("OR", Filter("county", "==", "Essex"))])
+    if parse_query("town_name == Limit") == limit \
+        and parse_query("county == order LIMIT 2") == limited \
+        and parse_query("town_name == limit or county == Essex") == either \
+        and parse_query("population > 1 LIMIT x").startswith("Invalid query: Bad IN STATES/ORDER BY/LIMIT clause"):
+        print("PASSED TEST FOURTEEN: parse_query(), clause keywords as values")
+        return
+    print("FAILED TEST FOURTEEN: parse_query(), clause keywords as values")
+
 if __name__ == '__main__':
     test_parse_query_one()
     test_parse_query_two()
@@ -96,3 +169,9 @@ if __name__ == '__main__':
     test_parse_query_six()
     test_parse_query_seven()
     test_parse_query_eight()
+    test_parse_query_nine()
+    test_parse_query_ten()
+    test_parse_query_eleven()
+    test_parse_query_twelve()
+    test_parse_query_thirteen()
+    test_parse_query_fourteen()
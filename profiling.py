@@ -0,0 +1,216 @@
+"""
+Opt-in profiling of slow queries.
+
+While profiling is enabled, every query run by query.py or run_fn is
+sampled: a background thread records the call stack of the query's thread
+and of the worker threads it reads Firestore on every few milliseconds
+(other queries and unrelated threads are left out of its profile). When
+the query took longer than the threshold, the samples are written in the
+folded-stack format flamegraph.pl, speedscope and inferno read
+(`thread;outer;...;inner count` lines), next to a JSON file holding the
+query text, its plan and timings. Only the newest profiles are kept.
+
+Profiling is off unless a threshold is set, through the environment:
+ - VT_PROFILE_MS: latency threshold in milliseconds (unset = disabled)
+ - VT_PROFILE_DIR: directory for the profiles (default: profiles)
+ - VT_PROFILE_KEEP: how many profiles to keep (default: 50)
+ - VT_PROFILE_INTERVAL_MS: sampling interval (default: 5)
+or by calling configure().
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Optional
+
+
+def _env_float(name: str, default: Optional[float]) -> Optional[float]:
+    value = os.environ.get(name)
+    try:
+        return float(value) if value else default
+    except ValueError:
+        return default
+
+
+# Latency above which a query's profile is written (None disables profiling)
+THRESHOLD_MS = _env_float("VT_PROFILE_MS", None)
+PROFILE_DIR = os.environ.get("VT_PROFILE_DIR", "profiles")
+KEEP = int(_env_float("VT_PROFILE_KEEP", 50))
+INTERVAL_MS = _env_float("VT_PROFILE_INTERVAL_MS", 5.0)
+
+
+def configure(threshold_ms: Optional[float], directory: str = None, keep: int = None,
+              interval_ms: float = None):
+    """Enables profiling of queries slower than threshold_ms (None disables it)"""
+    global THRESHOLD_MS, PROFILE_DIR, KEEP, INTERVAL_MS
+    THRESHOLD_MS = threshold_ms
+    PROFILE_DIR = directory or PROFILE_DIR
+    KEEP = keep or KEEP
+    INTERVAL_MS = interval_ms or INTERVAL_MS
+
+
+class Profile:
+    """The samples of one query and what it is written with"""
+
+    def __init__(self, query: Optional[str], plan: Any = None):
+        self.query = query
+        self.plan = plan
+        self.discarded = False
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = time.perf_counter()
+        self.threads = set()  # idents of the threads running the query
+
+
+class _Sampler:
+    """One background thread sampling the threads of all the active profiles"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._thread = None
+
+    def add(self, profile: Profile):
+        with self._lock:
+            profile.threads.add(threading.get_ident())
+            self._profiles.append(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="query-profiler", daemon=True)
+                self._thread.start()
+
+    def remove(self, profile: Profile):
+        with self._lock:
+            self._profiles.remove(profile)
+
+    def enter(self, profile: Profile):
+        """Samples the calling thread for the profile until leave()"""
+        with self._lock:
+            profile.threads.add(threading.get_ident())
+
+    def leave(self, profile: Profile):
+        with self._lock:
+            profile.threads.discard(threading.get_ident())
+
+    def _run(self):
+        while True:
+            time.sleep(INTERVAL_MS / 1000)
+            frames = sys._current_frames()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            with self._lock:
+                if not self._profiles:
+                    self._thread = None
+                    return
+                for profile in self._profiles:
+                    profile.stacks.update(_fold(names.get(ident, str(ident)), frames[ident])
+                                          for ident in profile.threads if ident in frames)
+                    profile.samples += 1
+
+
+_sampler = _Sampler()
+_active = threading.local()
+
+
+def _fold(thread_name: str, frame) -> str:
+    """A stack as a folded line: thread name, then frames from outermost to innermost"""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)})".replace(";", ":"))
+        frame = frame.f_back
+    return ";".join([thread_name.replace(";", ":")] + frames[::-1])
+
+
+@contextmanager
+def profile_query(query: Optional[str] = None, plan: Any = None):
+    """Samples the enclosed query and writes its profile if it ran longer than
+    the threshold. Does nothing when profiling is disabled or a profile is
+    already running on this thread (e.g. run_fn called by query.py)."""
+    current = getattr(_active, "profile", None)
+    if THRESHOLD_MS is None or current is not None:
+        if current is not None and current.plan is None:
+            current.plan = plan
+        yield current
+        return
+
+    profile = Profile(query, plan)
+    _active.profile = profile
+    _sampler.add(profile)
+    try:
+        yield profile
+    finally:
+        _sampler.remove(profile)
+        _active.profile = None
+        elapsed_ms = (time.perf_counter() - profile.started) * 1000
+        if elapsed_ms >= THRESHOLD_MS and not profile.discarded:
+            try:
+                _write(profile, elapsed_ms)
+            except OSError as e:
+                print(f"Could not write query profile: {e}", file=sys.stderr)
+
+
+def worker(fn: Callable) -> Callable:
+    """Wraps fn, to be run on a worker thread, so that its calls are sampled
+    with the query profiled on the calling thread (fn itself when none is)"""
+    profile = getattr(_active, "profile", None)
+    if profile is None:
+        return fn
+
+    def run(*args, **kwargs):
+        outer = getattr(_active, "profile", None)
+        _active.profile = profile
+        _sampler.enter(profile)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _sampler.leave(profile)
+            _active.profile = outer
+
+    return run
+
+
+def attach_plan(plan: Any):
+    """Records the plan of the query being profiled on this thread"""
+    profile = getattr(_active, "profile", None)
+    if profile is not None:
+        profile.plan = plan
+
+
+def discard():
+    """Drops the profile running on this thread (e.g. for a WATCH that runs until Ctrl-C)"""
+    profile = getattr(_active, "profile", None)
+    if profile is not None:
+        profile.discarded = True
+
+
+def _write(profile: Profile, elapsed_ms: float):
+    """Writes <stamp>.folded and <stamp>.json into PROFILE_DIR and deletes the oldest profiles"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}_{elapsed_ms:.0f}ms"
+    base = os.path.join(PROFILE_DIR, stamp)
+    with open(base + ".folded", "w") as f:
+        for stack, count in profile.stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    with open(base + ".json", "w") as f:
+        json.dump({"query": profile.query,
+                   "plan": repr(profile.plan) if profile.plan is not None else None,
+                   "elapsed_ms": round(elapsed_ms, 3),
+                   "threshold_ms": THRESHOLD_MS,
+                   "samples": profile.samples,
+                   "interval_ms": INTERVAL_MS,
+                   "stacks": os.path.basename(base) + ".folded"}, f, indent=2)
+    _rotate()
+
+
+def _rotate():
+    stems = sorted({name.rsplit(".", 1)[0] for name in os.listdir(PROFILE_DIR)
+                    if name.endswith((".folded", ".json"))})
+    for stem in stems[:max(0, len(stems) - KEEP)]:
+        for ext in (".folded", ".json"):
+            path = os.path.join(PROFILE_DIR, stem + ext)
+            if os.path.exists(path):
+                os.remove(path)
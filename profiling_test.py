@@ -0,0 +1,122 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+import profiling
+from profiling import profile_query, configure
+
+'''
+test_one checks that a query slower than the threshold writes folded stacks
+and a JSON file with its text and plan, and that a faster one writes nothing
+'''
+def test_one():
+    directory = tempfile.mkdtemp()
+    configure(50, directory, keep=10, interval_ms=2)
+    try:
+        with profile_query("county == Essex", plan="a plan"):
+            time.sleep(0.1)
+        with profile_query("county == Orleans"):
+            pass
+    finally:
+        configure(None)
+    names = sorted(os.listdir(directory))
+    if len(names) != 2:
+        print("FAILED TEST ONE")
+        return
+    with open(os.path.join(directory, names[1])) as f:
+        meta = json.load(f)
+    with open(os.path.join(directory, names[0])) as f:
+        lines = f.read().splitlines()
+    if (meta["query"] == "county == Essex" and meta["plan"] == "'a plan'"
+            and lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+            and any(line.startswith("MainThread;") and "test_one (profiling_test.py)" in line for line in lines)):
+        print("PASSED TEST ONE")
+        return
+    print("FAILED TEST ONE")
+
+'''
+test_two checks that only the newest profiles are kept
+'''
+def test_two():
+    directory = tempfile.mkdtemp()
+    configure(0, directory, keep=2, interval_ms=2)
+    try:
+        for n in range(4):
+            with profile_query(f"query {n}"):
+                time.sleep(0.01)
+    finally:
+        configure(None)
+    queries = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".json"):
+            with open(os.path.join(directory, name)) as f:
+                queries.append(json.load(f)["query"])
+    if queries == ["query 2", "query 3"]:
+        print("PASSED TEST TWO")
+        return
+    print("FAILED TEST TWO")
+
+'''
+test_three checks that a profile only samples its query's threads: two
+queries profiled at the same time on their own threads, a worker thread
+started through profiling.worker and an unrelated busy thread
+'''
+def test_three():
+    directory = tempfile.mkdtemp()
+    configure(0, directory, keep=10, interval_ms=1)
+    stop = threading.Event()
+
+    def spin_bystander():
+        while not stop.is_set():
+            pass
+
+    def spin_worker():
+        end = time.perf_counter() + 0.1
+        while time.perf_counter() < end:
+            pass
+
+    def query_a():
+        with profile_query("query a"):
+            worker_thread = threading.Thread(target=profiling.worker(spin_worker), name="query-a-worker")
+            worker_thread.start()
+            worker_thread.join()
+
+    def query_b():
+        with profile_query("query b"):
+            end = time.perf_counter() + 0.1
+            while time.perf_counter() < end:
+                pass
+
+    bystander = threading.Thread(target=spin_bystander, name="bystander")
+    bystander.start()
+    try:
+        threads = [threading.Thread(target=query_a, name="query-a"), threading.Thread(target=query_b, name="query-b")]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        stop.set()
+        bystander.join()
+        configure(None)
+    stacks = {}
+    for name in os.listdir(directory):
+        if name.endswith(".json"):
+            with open(os.path.join(directory, name)) as f:
+                meta = json.load(f)
+            with open(os.path.join(directory, meta["stacks"])) as f:
+                stacks[meta["query"]] = f.read()
+    a, b = stacks.get("query a", ""), stacks.get("query b", "")
+    if ("query-a-worker;" in a and "spin_worker" in a and "query_b" not in a
+            and "query-b;" in b and "query_a" not in b and "spin_worker" not in b
+            and "spin_bystander" not in a + b and "query-profiler" not in a + b):
+        print("PASSED TEST THREE")
+        return
+    print("FAILED TEST THREE")
+
+if __name__ == "__main__":
+    test_one()
+    test_two()
+    test_three()
@@ -1,8 +1,10 @@
 """Parse user queries, execute against Firestore and pretty-print results"""
 
+import re
 import shutil
 import sys
 import textwrap
+import time
 from typing import List, Any
 
 from parser import parse_query
@@ -10,7 +12,9 @@ from parser import parse_query
 import firebase_admin
 from firebase_admin import credentials, firestore
 
-from query_engine import run_fn
+from query_engine import run_fn, explain_fn, is_lookup_plan, subscribe, Delta
+from export import export_fn
+import profiling
 from models import Town
 
 def ensure_firestore():
@@ -30,13 +34,21 @@ Fields (case-insensitive):
   postal_code, office_phone, clerk_email, url
 
 Operators:
-  ==  !=  <  >  <=  >=  OF
+  ==  !=  <  >  <=  >=  OF  IN (...)  NOT IN (...)
+
+Optional clauses (in this order, after the conditions):
+  IN STATES VT, NH, ME   query these states (default: VT)
+  IN ALL STATES          query every loaded state
+  ORDER BY field [ASC|DESC]
+  LIMIT n
 
 Rules:
   - Fields/operators are case-insensitive; values are case-insensitive for this dataset.
   - Multi-word values require quotes (e.g., "South Burlington").
   - Only one AND or OR per query (no mixing), and OF cannot be combined with AND/OR.
   - OF town lookups are case-insensitive on town_name.
+  - OF accepts several fields and/or towns separated by commas and prints a table.
+  - ORDER BY and LIMIT cannot be used with OF.
 
 Examples:
   county == Lamoille
@@ -44,12 +56,31 @@ Examples:
   altitude < 500 and population > 16000
   postal_code == 05401
   altitude OF Burlington
+  altitude, population OF Burlington, Stowe, Barre
+  county IN (Essex, Orleans, Caledonia)
+  population > 10000 IN STATES VT, NH ORDER BY population DESC LIMIT 5
 
 Commands:
+  EXPLAIN <query>           Show the Firestore reads the query would run
+  EXPLAIN ANALYZE <query>   Run the query and show latency, documents read
+                            and rows returned for every read
+  EXPORT <query> TO <file> [FORMAT csv|arrow|parquet]
+                            Write every field of the results to a file
+                            (format defaults to the file extension, else csv)
+  WATCH <query>             Print the towns matching the query, then every
+                            town that enters (+), changes (~) or leaves (-)
+                            the results, until Ctrl-C
   help     Show this help
   quit     Exit the program
 """
 
+# EXPLAIN [ANALYZE] <query>
+EXPLAIN_RE = re.compile(r"^explain(\s+analyze)?\s+(.+)$", re.IGNORECASE | re.DOTALL)
+# WATCH <query>
+WATCH_RE = re.compile(r"^watch\s+(.+)$", re.IGNORECASE | re.DOTALL)
+# EXPORT <query> TO <file> [FORMAT csv|arrow|parquet]
+EXPORT_RE = re.compile(r'^export\s+(.+)\s+to\s+("[^"]+"|\S+)(?:\s+format\s+(\w+))?$', re.IGNORECASE | re.DOTALL)
+
 def format_results(rows: List[Any]) -> str:
     """Nicely prints a list of Firestore docs or single values (if executing)."""
     if not rows:
@@ -64,6 +95,10 @@ def format_results(rows: List[Any]) -> str:
         # Regular query results - normalize dicts via model
         towns = [Town.from_dict(r) for r in rows]
         names = [t.town_name or "<unknown>" for t in towns]
+        # Tag each town with its state when the results span several states
+        states = [r.get("state") for r in rows]
+        if len(set(states)) > 1:
+            names = [f"{n} ({s})" for n, s in zip(names, states)]
         result = ", ".join(names)
 
     # Detect terminal width (fallback to 80 if unknown)
@@ -72,6 +107,117 @@ def format_results(rows: List[Any]) -> str:
     # Wrap text so it doesn't overflow
     return textwrap.fill(result, width=width)
 
+def format_table(rows: List[dict], fields: List[str]) -> str:
+    """Prints the town-by-field table returned by bulk OF lookups"""
+    if not rows:
+        return "no information available. To learn more type \"help\""
+
+    columns = ["town_name"] + [f for f in fields if f != "town_name"]
+    if len({r.get("state") for r in rows}) > 1:
+        columns.append("state")
+    cells = [[str(r.get(c)) for c in columns] for r in rows]
+    widths = [max(len(c), *(len(row[i]) for row in cells)) for i, c in enumerate(columns)]
+
+    lines = ["  ".join(c.ljust(w) for c, w in zip(columns, widths)),
+             "  ".join("-" * w for w in widths)]
+    lines += ["  ".join(v.ljust(w) for v, w in zip(row, widths)) for row in cells]
+    return "\n".join(line.rstrip() for line in lines)
+
+def format_delta(delta: Delta) -> str:
+    """One line per town that entered (+), changed in (~) or left (-) the results of a WATCH"""
+    lines = []
+    for mark, rows in (("+", delta.added), ("~", delta.modified), ("-", delta.removed)):
+        lines += [f"{mark} {Town.from_dict(r).town_name or '<unknown>'}" for r in rows]
+    return "\n".join(lines)
+
+def watch(db, plan) -> None:
+    """Runs a live query until Ctrl-C"""
+    subscription = subscribe(db, plan, lambda delta: print(format_delta(delta), flush=True))
+    print("Watching for changes (Ctrl-C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print()
+    finally:
+        subscription.unsubscribe()
+
+def run_command(line: str) -> None:
+    """Parses one query (or EXPLAIN / EXPORT / WATCH command), runs it and prints the outcome"""
+    # EXPLAIN prefixes a regular query
+    explain = EXPLAIN_RE.match(line)
+    if explain:
+        line = explain.group(2)
+    # EXPORT and WATCH wrap a regular query too
+    export = EXPORT_RE.match(line)
+    if export:
+        line = export.group(1)
+    watching = WATCH_RE.match(line)
+    if watching:
+        line = watching.group(1)
+
+    # --- Parse stage (always) ---
+    try:
+        plan = parse_query(line)
+    except Exception as e:
+        # parse_query already returns an error string on ParseException,
+        # but guard here in case of unexpected errors
+        print(f"Invalid query: {e}")
+        return
+
+    # If your parse_query returns an error string, just print it
+    if isinstance(plan, str):
+        print(plan)
+        return
+    profiling.attach_plan(plan)
+
+    # ---- Connect to Firestore ----
+    try:
+        db = ensure_firestore()
+    except Exception as e:
+        print(f"Failed to initialize Firestore Connection: {e}")
+        print(f"Query parsed as: {plan}")
+
+    # ---- Explain the Query ----
+    if explain:
+        try:
+            print("\n".join(explain_fn(db, plan, analyze=bool(explain.group(1)))))
+        except Exception as e:
+            print(f"Execution error: {e}")
+        return
+
+    # ---- Export the Query ----
+    if export:
+        path = export.group(2).strip('"')
+        try:
+            count = export_fn(db, plan, path, export.group(3))
+            print(f"Exported {count} rows to {path}")
+        except Exception as e:
+            print(f"Export error: {e}")
+        return
+
+    # ---- Watch the Query ----
+    if watching:
+        # a watch lasts until Ctrl-C, its latency says nothing
+        profiling.discard()
+        try:
+            watch(db, plan)
+        except Exception as e:
+            print(f"Watch error: {e}")
+        return
+
+    # ---- Execute the Query ----
+    try:
+        # run the parsed query
+        rows = run_fn(db, plan)
+        if is_lookup_plan(plan):
+            print(format_table(rows, plan.fields))
+        else:
+            print(format_results(rows))
+
+    except Exception as e:
+        print(f"Execution error: {e}")
+
 def main() -> int:
     """This main method parses input, runs queries and prints results"""
     print("> Vermont Query CLI (type 'help' for help, 'quit' to exit)")
@@ -92,35 +238,9 @@ def main() -> int:
             print(HELP_TEXT)
             continue
 
-        # --- Parse stage (always) ---
-        try:
-            plan = parse_query(line)
-        except Exception as e:
-            # parse_query already returns an error string on ParseException,
-            # but guard here in case of unexpected errors
-            print(f"Invalid query: {e}")
-            continue
-
-        # If your parse_query returns an error string, just print it
-        if isinstance(plan, str):
-            print(plan)
-            continue
-
-        # ---- Connect to Firestore ----
-        try:
-            db = ensure_firestore()
-        except Exception as e:
-            print(f"Failed to initialize Firestore Connection: {e}")
-            print(f"Query parsed as: {plan}")
-
-        # ---- Execute the Query ----
-        try:
-            # run the parsed query
-            rows = run_fn(db, plan)
-            print(format_results(rows))
-
-        except Exception as e:
-            print(f"Execution error: {e}")
+        # queries slower than VT_PROFILE_MS get a profile (see profiling.py)
+        with profiling.profile_query(line):
+            run_command(line)
 
     return 0
 
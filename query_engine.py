@@ -1,16 +1,166 @@
 """
 This module declares the following classes:
  - Filter, with attributes field, op, value
- - QueryPlan, with the only attribute being filters
+ - QueryPlan, with attributes filters, scope, order_by, limit and fields
 
 It also provides the run_fn(db, plan) method, which executes
-the parsed QueryPlan against Firestore.
+the parsed QueryPlan against Firestore. A plan can target several
+per-state collections at once; run_fn queries them concurrently and
+merges the results. lookup_fn(db, towns, fields) fetches many fields
+of many towns in one pass.
+
+run_fn first turns the plan into a physical plan (build_steps), a list
+of Step reads that explain_fn(db, plan, analyze) can print and profile.
+stream_fn(db, plan) yields the same rows one at a time, and
+subscribe(db, plan, callback) keeps them up to date with snapshot listeners.
+run_many(db, plans) runs a batch of plans, sharing the reads they have in
+common.
+
+The towns of a state are read from the collection its pointer document
+names (see active_collections), so admin.py can load a new version and
+switch every reader over in a single write. A version can also be packed:
+a few chunk documents holding every field as a column array, which are
+read and cached whole and queried in Python.
 """
 
-from dataclasses import dataclass
-from typing import List, Tuple, Any
+import heapq
+import itertools
+import operator
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field as dc_field, replace as dc_replace
+from typing import List, Tuple, Any, Optional, Callable, Iterator, Dict
 from google.cloud.firestore_v1 import FieldFilter
 
+try:
+    from google.cloud.firestore_v1.query_profile import ExplainOptions, QueryExplainError
+except ImportError:  # older google-cloud-firestore releases cannot explain queries
+    ExplainOptions = QueryExplainError = None
+
+from models import FIELD_TYPES
+from profiling import profile_query, worker
+
+# State code -> name used to build the per-state collection names
+STATE_NAMES = {
+    "AL": "Alabama", "AK": "Alaska", "AZ": "Arizona", "AR": "Arkansas",
+    "CA": "California", "CO": "Colorado", "CT": "Connecticut", "DE": "Delaware",
+    "FL": "Florida", "GA": "Georgia", "HI": "Hawaii", "ID": "Idaho",
+    "IL": "Illinois", "IN": "Indiana", "IA": "Iowa", "KS": "Kansas",
+    "KY": "Kentucky", "LA": "Louisiana", "ME": "Maine", "MD": "Maryland",
+    "MA": "Massachusetts", "MI": "Michigan", "MN": "Minnesota", "MS": "Mississippi",
+    "MO": "Missouri", "MT": "Montana", "NE": "Nebraska", "NV": "Nevada",
+    "NH": "New_Hampshire", "NJ": "New_Jersey", "NM": "New_Mexico", "NY": "New_York",
+    "NC": "North_Carolina", "ND": "North_Dakota", "OH": "Ohio", "OK": "Oklahoma",
+    "OR": "Oregon", "PA": "Pennsylvania", "RI": "Rhode_Island", "SC": "South_Carolina",
+    "SD": "South_Dakota", "TN": "Tennessee", "TX": "Texas", "UT": "Utah",
+    "VT": "Vermont", "VA": "Virginia", "WA": "Washington", "WV": "West_Virginia",
+    "WI": "Wisconsin", "WY": "Wyoming",
+}
+
+DEFAULT_STATE = "VT"
+ALL_STATES = "ALL"
+
+# Firestore accepts at most this many values in a single `in` / `not-in` filter
+IN_QUERY_LIMIT = 30
+NOT_IN_QUERY_LIMIT = 10
+
+# QueryPlan operators that are spelled differently in Firestore
+FIRESTORE_OPS = {"IN": "in", "NOT IN": "not-in"}
+
+RANGE_OPS = ("<", "<=", ">", ">=")
+
+# Collection of pointer documents (one per state code) naming the active
+# versioned collection of each state, written by admin.py
+POINTER_COLLECTION = "Active_Collections"
+# How long a resolved pointer is reused before it is read again (seconds)
+POINTER_TTL = 60.0
+
+# Storage layouts of a collection version, recorded in its pointer: one
+# document per town, or towns packed into chunk documents of column arrays
+DOCUMENTS_LAYOUT = "documents"
+PACKED_LAYOUT = "packed"
+# Id of the document describing the chunks of a packed collection
+MANIFEST_ID = "manifest"
+
+# Most Firestore reads one call runs at once; steps multiply as states x OR
+# branches x IN chunks, so the rest wait for a free worker
+MAX_READ_WORKERS = 16
+
+# How many streamed rows stream_fn buffers between the Firestore streams and its consumer
+STREAM_BUFFER_SIZE = 1000
+
+# Python implementation of every filter operator, for residual filters
+PREDICATE_OPS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "IN": lambda value, values: value in values,
+    "NOT IN": lambda value, values: value not in values,
+}
+
+
+def collection_name(state: str) -> str:
+    """Returns the Firestore collection holding the towns of a state (e.g. VT -> Vermont_Municipalities)"""
+    return f"{STATE_NAMES[state.upper()]}_Municipalities"
+
+
+def versioned_collection_name(state: str, version: int) -> str:
+    """Returns the collection admin.py loads a version of a state into (e.g. Vermont_Municipalities_v3)"""
+    return f"{collection_name(state)}_v{version}"
+
+
+# db -> {state: ((active collection, layout), time it expires)}, see active_collections.
+# Keyed on the client itself (not its id, which a new client can reuse) and
+# dropped along with it
+_pointer_cache = weakref.WeakKeyDictionary()
+_pointer_lock = threading.Lock()
+
+# db -> {state: (packed collection, its rows as (document id, data))}, see _packed_rows
+_packed_cache = weakref.WeakKeyDictionary()
+_packed_lock = threading.Lock()
+# db -> {state: lock held while streaming that state's packed collection}
+_packed_state_locks = weakref.WeakKeyDictionary()
+
+
+def active_collections(db, states: List[str]) -> Dict[str, str]:
+    """Returns the collection currently holding the towns of each state.
+    admin.py loads every version into a fresh collection and then flips the
+    state's pointer document to it; pointers are cached for POINTER_TTL
+    seconds and the missing ones fetched in one round trip. States without a
+    pointer use their unversioned collection."""
+    return {state: collection for state, (collection, _) in _active_pointers(db, states).items()}
+
+
+def _active_pointers(db, states: List[str]) -> Dict[str, Tuple[str, str]]:
+    """The (collection, layout) of each state, see active_collections"""
+    now = time.monotonic()
+    states = [s.upper() for s in states]
+    active = {}
+    with _pointer_lock:
+        cache = _pointer_cache.setdefault(db, {})
+        for state in states:
+            cached = cache.get(state)
+            if cached is not None and cached[1] > now:
+                active[state] = cached[0]
+    missing = [s for s in states if s not in active]
+    if missing:
+        pointers = db.collection(POINTER_COLLECTION)
+        for snapshot in db.get_all([pointers.document(s) for s in missing]):
+            data = snapshot.to_dict() if snapshot.exists else None
+            if data and data.get("collection"):
+                active[snapshot.id] = (data["collection"], data.get("layout", DOCUMENTS_LAYOUT))
+        with _pointer_lock:
+            for state in missing:
+                active.setdefault(state, (collection_name(state), DOCUMENTS_LAYOUT))
+                cache[state] = (active[state], now + POINTER_TTL)
+    return active
+
 
 @dataclass
 class Filter:
@@ -19,8 +169,8 @@ class Filter:
 
     Attributes:
      - field (str): the Firestore document field to filter on
-     - op (str): the comparison operator (e.g., '==', '>', '<', 'of')
-     - value (Any): the comparison value for the filter
+     - op (str): the comparison operator (e.g., '==', '>', '<', 'of', 'IN', 'NOT IN')
+     - value (Any): the comparison value for the filter (a list for IN / NOT IN)
 
     Two Filter instances are equal if their field, operator and value are equal
     """
@@ -43,85 +193,963 @@ class QueryPlan:
 
     Attributes:
      - filters (List[Tuple[str, Filter]]): a list of (connector, Filter) pairs
+     - scope (List[str]): the state codes to query (e.g. ["VT", "NH"]), or ["ALL"]
+     - order_by (Optional[Tuple[str, str]]): (field, "ASC" | "DESC") to sort on
+     - limit (Optional[int]): the maximum number of rows to return
+     - fields (List[str]): the fields a bulk OF lookup returns for every town
 
     Two QueryPlan instances are equal if their filters are equal (if they have
-    the same sequence of connectors and filters)
+    the same sequence of connectors and filters) and they have the same scope,
+    ordering, limit and fields
     """
     # list of (connector, filter), first connector can be ""; connectors are "AND" or "OR"
     filters: List[Tuple[str, Filter]]
+    scope: List[str] = dc_field(default_factory=lambda: [DEFAULT_STATE])
+    order_by: Optional[Tuple[str, str]] = None
+    limit: Optional[int] = None
+    fields: List[str] = dc_field(default_factory=list)
 
     def __eq__(self, other):
-        if self.filters == other.filters:
+        if (self.filters == other.filters
+                and self.scope == other.scope
+                and self.order_by == other.order_by
+                and self.limit == other.limit
+                and self.fields == other.fields):
             return True
         return False
 
-def run_fn(db, plan: QueryPlan):
-    """Executes a parsed QueryPlan against the Vermont_Municipalities collection in Firestore"""
-    # Start with collection reference
-    query = db.collection("Vermont_Municipalities")
-    saw_or = False  # add this right after you create `query`
-
-    if (len(plan.filters) == 1 and
-            plan.filters[0][0] == "" and
-            plan.filters[0][1].field.lower() == "town_name" and
-            plan.filters[0][1].op in ("==", "OF")):
-
-        want = str(plan.filters[0][1].value).lower()
-        matches = []
-        for doc in db.collection("Vermont_Municipalities").stream():
-            got = str(doc.to_dict().get("town_name", ""))
-            if got.lower() == want:
-                matches.append(got)
-        if matches:
-            return [f"{matches[0]}... What did you expect?"]
-        return []
-
-    # Apply all filters from the QueryPlan
+
+def resolve_states(db, scope: List[str]) -> List[str]:
+    """Turns a plan scope into the list of state codes to query.
+    ALL expands to every state that has a collection in Firestore."""
+    if ALL_STATES not in scope:
+        return [s.upper() for s in scope]
+    existing = {c.id for c in db.collections()}
+    if POINTER_COLLECTION in existing:
+        active = active_collections(db, list(STATE_NAMES))
+        return [s for s in STATE_NAMES if active[s] in existing]
+    return [s for s in STATE_NAMES if collection_name(s) in existing]
+
+
+def _order_and_limit(rows: list, plan: QueryPlan) -> list:
+    """Applies the plan's ORDER BY and LIMIT to already fetched rows"""
+    if plan.order_by:
+        field_name, direction = plan.order_by
+        # rows without a value for the field always go last
+        present = [r for r in rows if r.get(field_name) is not None]
+        missing = [r for r in rows if r.get(field_name) is None]
+        present.sort(key=lambda r: r[field_name], reverse=(direction == "DESC"))
+        rows = present + missing
+    if plan.limit is not None:
+        rows = rows[:plan.limit]
+    return rows
+
+
+def _is_value_plan(plan: QueryPlan) -> bool:
+    """True for plans that return plain values instead of documents (OF lookups
+    and the town_name special case)"""
+    first = plan.filters[0][1]
+    return (first.op == "OF" or
+            (len(plan.filters) == 1 and
+             first.field.lower() == "town_name" and
+             first.op == "=="))
+
+
+def is_lookup_plan(plan: QueryPlan) -> bool:
+    """True for bulk OF plans (several fields and/or several towns)"""
+    return plan.filters[0][1].op == "OF" and isinstance(plan.filters[0][1].value, list)
+
+
+@dataclass
+class StepStats:
+    """What executing a Step cost, recorded every time it runs (EXPLAIN ANALYZE
+    replaces docs_read with Firestore's own count and adds the indexes used)"""
+    latency_ms: float = 0.0
+    docs_read: int = 0
+    rows: int = 0
+    indexes: List[str] = dc_field(default_factory=list)
+
+
+@dataclass
+class Step:
+    """
+    One Firestore read of a physical plan, as built by build_steps
+
+    Attributes:
+     - state (str): the state whose collection is read
+     - collection (Optional[str]): the collection read, once resolved (else the state's unversioned one)
+     - packed (bool): the collection is packed, so its cached rows are filtered in Python
+     - filters (List[Filter]): filters evaluated by Firestore (none means a full scan)
+     - residual (List[Filter]): filters evaluated in Python on the streamed documents
+     - order_by (Optional[Tuple[str, str]]): ORDER BY evaluated by Firestore
+     - limit (Optional[int]): LIMIT evaluated by Firestore
+     - stop_after (Optional[int]): stop streaming once this many documents matched
+     - fields (List[str]): the fields Firestore returns (empty for whole documents)
+     - town (Optional[str]): only keep the town with this name (case-insensitive)
+     - stats (Optional[StepStats]): what the step cost, once analyzed
+    """
+    state: str
+    collection: Optional[str] = None
+    packed: bool = False
+    filters: List[Filter] = dc_field(default_factory=list)
+    residual: List[Filter] = dc_field(default_factory=list)
+    order_by: Optional[Tuple[str, str]] = None
+    limit: Optional[int] = None
+    stop_after: Optional[int] = None
+    fields: List[str] = dc_field(default_factory=list)
+    town: Optional[str] = None
+    stats: Optional[StepStats] = None
+
+    def query(self, db):
+        """Builds the Firestore query for this step"""
+        query = db.collection(self.collection or collection_name(self.state))
+        for f in self.filters:
+            query = query.where(filter=_field_filter(f))
+        if self.fields:
+            query = query.select(self.fields)
+        if self.order_by:
+            field_name, direction = self.order_by
+            query = query.order_by(field_name, direction="DESCENDING" if direction == "DESC" else "ASCENDING")
+        if self.limit is not None:
+            query = query.limit(self.limit)
+        return query
+
+    def describe(self) -> List[str]:
+        """Human readable lines describing the step, used by EXPLAIN"""
+        if self.packed:
+            kind = "packed scan (cached chunks)"
+        else:
+            kind = "query" if self.filters else "full scan"
+        lines = [f"{kind} {self.collection or collection_name(self.state)}"]
+        if self.filters:
+            lines.append("  server filter: " + " AND ".join(_describe_filter(f) for f in self.filters))
+        if self.fields:
+            lines.append("  projection: " + ", ".join(self.fields))
+        if self.order_by:
+            lines.append(f"  server order: {self.order_by[0]} {self.order_by[1]}")
+        if self.limit is not None:
+            lines.append(f"  server limit: {self.limit}")
+        if self.town is not None:
+            lines.append(f"  client filter: town_name matches '{self.town}' (case-insensitive)")
+        if self.residual:
+            lines.append("  client filter: " + " AND ".join(_describe_filter(f) for f in self.residual))
+        if self.stop_after is not None:
+            lines.append(f"  stop after {self.stop_after} match(es)")
+        return lines
+
+
+def _describe_filter(f: Filter) -> str:
+    if isinstance(f.value, list):
+        shown = ", ".join(repr(v) for v in f.value[:5])
+        if len(f.value) > 5:
+            shown += f", ... ({len(f.value)} values)"
+        return f"{f.field} {f.op} ({shown})"
+    return f"{f.field} {f.op} {f.value!r}"
+
+
+def build_steps(db, plan: QueryPlan) -> List[Step]:
+    """Builds the physical plan of a QueryPlan: every Firestore read run_fn
+    will issue, across all the states in scope"""
+    return _bind_collections(db, _plan_steps(resolve_states(db, plan.scope), plan))
+
+
+def _bind_collections(db, steps: List[Step]) -> List[Step]:
+    """Points every step at the active collection of its state"""
+    active = _active_pointers(db, list(dict.fromkeys(step.state for step in steps)))
+    bound = []
+    for step in steps:
+        collection, layout = active[step.state]
+        step.collection = collection
+        bound.append(_packed_step(step) if layout == PACKED_LAYOUT else step)
+    return bound
+
+
+def _packed_step(step: Step) -> Step:
+    """Turns a step into a scan of its packed collection, where every filter,
+    ordering and limit is evaluated in Python"""
+    return dc_replace(step, packed=True, filters=[], residual=step.filters + step.residual,
+                      order_by=None, limit=None, fields=[],
+                      # without the server order, any match may be one of the first ones
+                      stop_after=None if step.order_by else (step.stop_after or step.limit))
+
+
+def _packed_rows(db, step: Step) -> Tuple[List[Tuple[str, dict]], int]:
+    """The rows of a packed collection and the documents read to get them.
+    A version is never modified once its pointer names it, so its rows are
+    cached until the state points at another collection."""
+    with _packed_lock:
+        cache = _packed_cache.setdefault(db, {})
+        cached = cache.get(step.state)
+        if cached is not None and cached[0] == step.collection:
+            return cached[1], 0
+        state_lock = _packed_state_locks.setdefault(db, {}).setdefault(step.state, threading.Lock())
+    # only queries of the same state wait for a cold stream, and they then
+    # share its rows instead of streaming the chunks again
+    with state_lock:
+        with _packed_lock:
+            cached = cache.get(step.state)
+        if cached is not None and cached[0] == step.collection:
+            return cached[1], 0
+        # one stream of the manifest and every chunk
+        docs = {doc.id: doc.to_dict() for doc in db.collection(step.collection).stream()}
+        manifest = docs.get(MANIFEST_ID)
+        if manifest is None or any(chunk_id not in docs for chunk_id in manifest["chunks"]):
+            raise RuntimeError(f"{step.collection} is not a complete packed collection")
+        rows = []
+        for chunk_id in manifest["chunks"]:
+            chunk = docs[chunk_id]
+            for i, doc_id in enumerate(chunk["ids"]):
+                rows.append((doc_id, {f: chunk[f][i] for f in manifest["fields"]}))
+        with _packed_lock:
+            cache[step.state] = (step.collection, rows)
+        return rows, len(docs)
+
+
+def _plan_steps(states: List[str], plan: QueryPlan) -> List[Step]:
+    first = plan.filters[0][1]
+
+    if is_lookup_plan(plan):
+        fields = list(dict.fromkeys(["town_name"] + (plan.fields or [first.field])))
+        return [Step(state, filters=[chunk], fields=fields)
+                for state in states
+                for chunk in _chunk_in(Filter("town_name", "IN", _lookup_names(first.value)))]
+
+    if _is_value_plan(plan):
+        # OF and the town_name special case match names case-insensitively,
+        # which Firestore cannot do, so they scan the collection
+        return [Step(state, town=str(first.value), stop_after=1) for state in states]
+
+    return _document_steps(states, plan)
+
+
+def _lookup_names(towns: List[str]) -> List[str]:
+    """The town_name values an `in` query needs to find the towns whatever
+    their case: each name as given and capitalized like the stored names
+    (Firestore compares strings exactly; _merge then matches case-insensitively)"""
+    return list(dict.fromkeys(variant for town in towns
+                              for variant in (town, " ".join(word.capitalize() for word in town.split()))))
+
+
+def _document_steps(states: List[str], plan: QueryPlan) -> List[Step]:
+    """Builds the steps of a plan that returns documents"""
+    # Split the filters into AND-chains; every OR starts an independent branch
+    branches = []
     for connector, f in plan.filters:
-        if connector == "":
-            # this is the first query and will always run
-            if f.op == "OF":
-                # Case-insensitive search for town name
-                all_towns = db.collection("Vermont_Municipalities").stream()
-                for doc in all_towns:
-                    town_data = doc.to_dict()
-                    # Get town name from the data
-                    town_name = town_data.get("town_name", "")
-                    if town_name.lower() == f.value.lower():
-                        return [town_data.get(f.field)]
-                return []
-
-            query = query.where(filter=FieldFilter(f.field, f.op, f.value))
-
-            # Execute
-            docs = list(query.stream())
-
-        elif connector == "AND":
-            # add another "where" to the query
-            # can assume here that the operator is not "OF"
-            query = query.where(filter=FieldFilter(f.field, f.op, f.value))
-
-        else:  # connector == "OR"
-            # Seed docs from the current AND-chain once
-            if not saw_or:
-                docs = list(query.stream())
-
-            # Run the OR branch independently
-            new_query = (db.collection("Vermont_Municipalities")
-                         .where(filter=FieldFilter(f.field, f.op, f.value)))
-            new_docs = list(new_query.stream())
-
-            # Union by document id (avoid duplicates)
-            existing_ids = {d.id for d in docs}
-            for nd in new_docs:
-                if nd.id not in existing_ids:
-                    docs.append(nd)
-
-            saw_or = True
-
-    # Execute and return dicts instead of snapshots
-    # Only run the chained AND query when there was NO OR
-    if not saw_or:
-        docs = list(query.stream())
-
-    return [doc.to_dict() | {"id": doc.id} for doc in docs]
+        if connector != "AND":
+            branches.append([])
+        branches[-1].append(f)
+
+    # Each branch becomes one Firestore query (or one per chunk of a long IN
+    # list) with the filters Firestore can serve from its single-field
+    # indexes; the rest are checked in Python on the streamed documents
+    steps = []
+    for state in states:
+        for branch in branches:
+            pushed, residual = _split_pushdown(branch)
+            # ordering on another field than the filtered one needs a composite index
+            push_order = plan.order_by is not None and all(f.field == plan.order_by[0] for f in pushed)
+            limit = plan.limit if (push_order or not plan.order_by) else None
+            for combo in itertools.product(*[_chunk_in(f) for f in pushed]):
+                steps.append(Step(state,
+                                  filters=list(combo),
+                                  residual=residual,
+                                  order_by=plan.order_by if push_order else None,
+                                  limit=limit if not residual else None,
+                                  stop_after=limit if residual else None))
+    return steps
+
+
+def execute_steps(db, steps: List[Step], analyze: bool = False) -> List[List[Tuple[str, dict]]]:
+    """Runs every step concurrently (so latency tracks the slowest read rather
+    than their sum) and returns the matching (document id, data) of each"""
+    if len(steps) <= 1:
+        return [_execute(db, step, analyze) for step in steps]
+    with ThreadPoolExecutor(max_workers=min(len(steps), MAX_READ_WORKERS)) as pool:
+        return list(pool.map(worker(lambda step: _execute(db, step, analyze)), steps))
+
+
+def _execute(db, step: Step, analyze: bool) -> List[Tuple[str, dict]]:
+    """Streams one step and keeps the documents that pass its client-side
+    filters, stopping as soon as enough of them have been found"""
+    return _execute_shared(db, step, [step], analyze)[0]
+
+
+def _execute_shared(db, read: Step, consumers: List[Step], analyze: bool = False) -> List[List[Tuple[str, dict]]]:
+    """Streams the Firestore query of `read` once and hands every document to
+    each consumer step, which keeps the ones passing its own client-side
+    filters. The stream stops as soon as every consumer has found enough
+    documents. Returns the matching (document id, data) of each consumer."""
+    start = time.perf_counter()
+    stream = None
+    if read.packed:
+        rows, read_count = _packed_rows(db, read)
+    else:
+        query = read.query(db)
+        if analyze and ExplainOptions is not None:
+            stream = query.stream(explain_options=ExplainOptions(analyze=True))
+        else:
+            stream = query.stream()
+        rows = ((doc.id, doc.to_dict()) for doc in stream)
+        read_count = 0
+
+    matchers = [_matcher(consumer) for consumer in consumers]
+    matches = [[] for _ in consumers]
+    pending = list(range(len(consumers)))
+    for doc_id, data in rows:
+        if stream is not None:
+            read_count += 1
+        for i in list(pending):
+            if matchers[i](data):
+                matches[i].append((doc_id, data))
+                if consumers[i].stop_after is not None and len(matches[i]) >= consumers[i].stop_after:
+                    pending.remove(i)
+        if not pending:
+            break
+
+    # a query returning no documents is still billed one read (cached chunks cost none)
+    latency_ms = (time.perf_counter() - start) * 1000
+    if stream is not None:
+        read_count = max(read_count, 1)
+    read.stats = StepStats(latency_ms=latency_ms, docs_read=read_count,
+                           rows=sum(len(m) for m in matches))
+    for consumer, consumer_matches in zip(consumers, matches):
+        if consumer is not read:
+            consumer.stats = StepStats(latency_ms=latency_ms, rows=len(consumer_matches))
+    if analyze:
+        if ExplainOptions is not None and hasattr(stream, "get_explain_metrics"):
+            try:
+                metrics = stream.get_explain_metrics()
+                read.stats.docs_read = metrics.execution_stats.read_operations
+                read.stats.indexes = [str(i.get("query_scope", "")) + " " + str(i.get("properties", ""))
+                                      for i in metrics.plan_summary.indexes_used]
+            except QueryExplainError:
+                pass  # the stream was stopped early, keep our own count
+    return matches
+
+
+def _matcher(step: Step) -> Callable[[dict], bool]:
+    """The client-side part of a step (town name and residual filters) as a predicate"""
+    predicate = compile_filters(step.residual)
+    if step.town is None:
+        return predicate
+    town = step.town.lower()
+    return lambda data: str(data.get("town_name", "")).lower() == town and predicate(data)
+
+
+def _iter_matches(step: Step, docs) -> Iterator[Tuple[str, dict]]:
+    """Yields the (document id, data) of the streamed documents that pass the
+    step's client-side filters, stopping as soon as enough have been found"""
+    matches = _matcher(step)
+    found = 0
+    for doc in docs:
+        data = doc.to_dict()
+        if matches(data):
+            yield doc.id, data
+            found += 1
+            if step.stop_after is not None and found >= step.stop_after:
+                return
+
+
+def _stream_rows(db, step: Step) -> Iterator[dict]:
+    """Streams the rows of one step, in the order Firestore returns them"""
+    if step.packed:
+        rows = _execute(db, step, analyze=False)
+    else:
+        rows = _iter_matches(step, step.query(db).stream())
+    for doc_id, data in rows:
+        yield data | {"id": doc_id, "state": step.state}
+
+
+def _concurrent_rows(db, steps: List[Step]) -> Iterator[dict]:
+    """Streams the rows of several steps as they arrive. Up to
+    MAX_READ_WORKERS threads stream the steps into a bounded buffer, so memory
+    stays bounded however large the result is, and the steps stop once the
+    consumer does."""
+    if len(steps) == 1:
+        yield from _stream_rows(db, steps[0])
+        return
+
+    buffer = queue.Queue(maxsize=STREAM_BUFFER_SIZE)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    todo = queue.SimpleQueue()
+    for step in steps:
+        todo.put(step)
+
+    def produce():
+        while not stop.is_set():
+            try:
+                step = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                for row in _stream_rows(db, step):
+                    if not put(row):
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+                return
+
+    for _ in range(min(len(steps), MAX_READ_WORKERS)):
+        threading.Thread(target=worker(produce), daemon=True).start()
+    try:
+        remaining = len(steps)
+        while remaining:
+            item = buffer.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+
+
+def stream_fn(db, plan: QueryPlan) -> Iterator[dict]:
+    """Like run_fn, but yields the result rows one at a time as Firestore
+    streams them instead of building the whole list. OF lookups yield
+    town-by-field rows (as lookup_fn), and the town_name special case yields
+    the matching documents. Rows are only buffered when the plan has an
+    ORDER BY that Firestore cannot apply."""
+    first = plan.filters[0][1]
+    if first.op == "OF":
+        if not is_lookup_plan(plan):
+            plan = QueryPlan(filters=[("", Filter(first.field, "OF", [str(first.value)]))],
+                             scope=plan.scope, fields=[first.field])
+        # one row per town asked for, small enough to fetch in one go
+        yield from run_fn(db, plan)
+        return
+
+    steps = _bind_collections(db, _document_steps(resolve_states(db, plan.scope), plan))
+    if plan.order_by and not all(step.order_by for step in steps):
+        # the rows have to be sorted in Python, which needs all of them
+        yield from _merge(plan, steps, execute_steps(db, steps))
+        return
+
+    if plan.order_by:
+        # every step streams in order already, so merge the streams
+        field_name, direction = plan.order_by
+        rows = heapq.merge(*[_stream_rows(db, step) for step in steps],
+                           key=lambda row: row[field_name], reverse=(direction == "DESC"))
+    else:
+        rows = _concurrent_rows(db, steps)
+
+    # Union by (state, document id), as in run_fn
+    seen = set()
+    count = 0
+    for row in rows:
+        if len(steps) > 1:
+            if (row["state"], row["id"]) in seen:
+                continue
+            seen.add((row["state"], row["id"]))
+        yield row
+        count += 1
+        if plan.limit is not None and count >= plan.limit:
+            return
+
+
+def _merge(plan: QueryPlan, steps: List[Step], results: List[List[Tuple[str, dict]]]) -> list:
+    """Combines the documents read by the steps into run_fn's result"""
+    first = plan.filters[0][1]
+
+    if is_lookup_plan(plan):
+        fields = plan.fields or [first.field]
+        # Several towns can share a name (e.g. Barre city and town), keep them all
+        by_name = {}
+        for step, docs in zip(steps, results):
+            for _, data in docs:
+                row = {"town_name": data.get("town_name")}
+                row.update({f: data.get(f) for f in fields})
+                row["state"] = step.state
+                by_name.setdefault(str(row["town_name"]).lower(), []).append(row)
+        names = list(dict.fromkeys(name.lower() for name in first.value))
+        return [row for name in names for row in by_name.get(name, [])]
+
+    if _is_value_plan(plan):
+        found = [data for docs in results for _, data in docs]
+        if first.field.lower() == "town_name":
+            # the special case only reports the first town found
+            if found:
+                return [f"{found[0].get('town_name')}... What did you expect?"]
+            return []
+        return [data.get(first.field) for data in found]
+
+    # Union by (state, document id) to avoid duplicates across OR branches,
+    # IN chunks and states, and return dicts instead of snapshots
+    rows = []
+    seen = set()
+    for step, docs in zip(steps, results):
+        for doc_id, data in docs:
+            if (step.state, doc_id) not in seen:
+                seen.add((step.state, doc_id))
+                rows.append(data | {"id": doc_id, "state": step.state})
+    # Every step comes back ordered and limited on its own, so order and
+    # limit the merged rows again
+    return _order_and_limit(rows, plan)
+
+
+def lookup_fn(db, towns: List[str], fields: List[str], scope: Optional[List[str]] = None) -> List[dict]:
+    """Looks up many fields of many towns in one pass and returns a town-by-field
+    table: one row per matching town, in the order the towns were asked for.
+    Towns are fetched with chunked `in` queries on town_name (so a few round
+    trips instead of one collection scan per town), all chunks and states
+    running concurrently. Like OF, names match case-insensitively; towns
+    that are not found are left out."""
+    plan = QueryPlan(filters=[("", Filter(fields[0], "OF", list(towns)))],
+                     scope=scope or [DEFAULT_STATE], fields=list(fields))
+    return run_fn(db, plan)
+
+
+def run_fn(db, plan: QueryPlan):
+    """Executes a parsed QueryPlan against every collection in its scope.
+    The Firestore reads run concurrently, so latency tracks the slowest
+    state rather than the sum of them."""
+    with profile_query(plan=plan):
+        return execute_plan(db, plan)[0]
+
+
+def execute_plan(db, plan: QueryPlan) -> Tuple[list, List[Step]]:
+    """Executes a plan like run_fn and also returns its steps, whose stats
+    tell what every read cost (used by loadtest.py)"""
+    steps = build_steps(db, plan)
+    return _merge(plan, steps, execute_steps(db, steps)), steps
+
+
+def run_many(db, plans: List[QueryPlan]) -> List[list]:
+    """Executes a batch of plans and returns the result of each, as run_fn
+    would. Steps of different plans that send Firestore the same query (every
+    OF town lookup scans its collection, for instance) share one stream, and
+    each plan's client-side filters are evaluated on the shared documents;
+    bulk OF lookups of a state are merged into one set of `in` reads. So a
+    batch of N OF lookups reads each collection once."""
+    plan_steps = [build_steps(db, plan) for plan in plans]
+    lookup_reads = _merged_lookup_reads(plans, plan_steps)
+
+    reads = {}  # server-side query -> the Step reading it
+    consumers = {}  # server-side query -> [(plan index, step index, consumer Step)]
+    for n, (plan, steps) in enumerate(zip(plans, plan_steps)):
+        for i, step in enumerate(steps):
+            if is_lookup_plan(plan):
+                if step.state in {s.state for s in steps[:i]}:
+                    continue  # the merged reads already serve every town of this state
+                names = Filter("town_name", "IN", _lookup_names(plan.filters[0][1].value))
+                shared = [(read, dc_replace(step, filters=[], residual=[names], fields=[]))
+                          for read in lookup_reads[step.collection]]
+            else:
+                shared = [(dc_replace(step, residual=[], town=None, stop_after=None), step)]
+            for read, consumer in shared:
+                key = _read_key(read)
+                reads.setdefault(key, read)
+                consumers.setdefault(key, []).append((n, i, consumer))
+
+    keys = list(reads)
+
+    def execute(key):
+        return _execute_shared(db, reads[key], [c for _, _, c in consumers[key]])
+
+    if len(keys) <= 1:
+        matched = [execute(key) for key in keys]
+    else:
+        with ThreadPoolExecutor(max_workers=min(len(keys), MAX_READ_WORKERS)) as pool:
+            matched = list(pool.map(worker(execute), keys))
+
+    # hand every plan its consumers' documents, in the order of its steps
+    per_plan = [[] for _ in plans]
+    for key, docs in zip(keys, matched):
+        for (n, i, consumer), consumer_docs in zip(consumers[key], docs):
+            per_plan[n].append((i, consumer, consumer_docs))
+    results = []
+    for plan, parts in zip(plans, per_plan):
+        parts.sort(key=lambda part: part[0])
+        results.append(_merge(plan, [c for _, c, _ in parts], [d for _, _, d in parts]))
+    return results
+
+
+def _merged_lookup_reads(plans: List[QueryPlan], plan_steps: List[List[Step]]) -> Dict[str, List[Step]]:
+    """The `in` reads fetching, per collection, every town any bulk OF lookup of
+    the batch asks for, with every field any of them needs"""
+    names, fields, sample = {}, {}, {}
+    for plan, steps in zip(plans, plan_steps):
+        if not is_lookup_plan(plan):
+            continue
+        for step in steps:
+            names.setdefault(step.collection, {}).update(dict.fromkeys(_lookup_names(plan.filters[0][1].value)))
+            fields.setdefault(step.collection, {}).update(dict.fromkeys(step.fields))
+            sample[step.collection] = step
+    reads = {}
+    for collection, step in sample.items():
+        reads[collection] = [Step(step.state, collection=collection, filters=[chunk], fields=list(fields[collection]))
+                             for chunk in _chunk_in(Filter("town_name", "IN", list(names[collection])))]
+        if step.packed:
+            # the cached chunks hold every town, so one scan serves all lookups
+            reads[collection] = [_packed_step(reads[collection][0])]
+    return reads
+
+
+def _read_key(step: Step) -> tuple:
+    """Identifies the Firestore query of a step"""
+    return (step.collection or collection_name(step.state), step.packed, repr(step.filters),
+            step.order_by, step.limit, tuple(step.fields))
+
+
+def explain_fn(db, plan: QueryPlan, analyze: bool = False) -> List[str]:
+    """Describes the physical plan run_fn executes for a QueryPlan. With
+    analyze, the plan is executed and every step reports its latency,
+    documents read and rows returned"""
+    start = time.perf_counter()
+    steps = build_steps(db, plan)
+    lines = []
+    if ALL_STATES in plan.scope:
+        lines.append("list collections to resolve IN ALL STATES")
+    lines.append(f"resolve active collections from {POINTER_COLLECTION} (cached for {POINTER_TTL:g}s)")
+    if analyze:
+        rows = _merge(plan, steps, execute_steps(db, steps, analyze=True))
+    for n, step in enumerate(steps, 1):
+        description = step.describe()
+        lines.append(f"{n}. {description[0]}")
+        lines.extend("   " + line for line in description[1:])
+        if step.stats is not None:
+            lines.append(f"   -> {step.stats.latency_ms:.1f} ms, {step.stats.docs_read} docs read, "
+                         f"{step.stats.rows} rows")
+            lines.extend(f"   -> index: {index}" for index in step.stats.indexes)
+    if len(steps) > 1:
+        lines.append(f"steps run concurrently ({len(steps)})")
+
+    merge = []
+    if is_lookup_plan(plan):
+        merge.append("town-by-field table in the order the towns were given")
+    elif _is_value_plan(plan):
+        merge.append(f"{plan.filters[0][1].field} of the first match in each state")
+    else:
+        merge.append("union by document id")
+        if plan.order_by:
+            merge.append(f"order by {plan.order_by[0]} {plan.order_by[1]}")
+        if plan.limit is not None:
+            merge.append(f"limit {plan.limit}")
+    if merge:
+        lines.append("merge: " + ", ".join(merge))
+
+    if analyze:
+        total_ms = (time.perf_counter() - start) * 1000
+        docs_read = sum(step.stats.docs_read for step in steps)
+        lines.append(f"total: {total_ms:.1f} ms, {docs_read} docs read, {len(rows)} rows returned")
+    return lines
+
+
+@dataclass
+class Delta:
+    """
+    The changes to a live query's results delivered to a subscribe callback
+
+    Attributes:
+     - added (List[dict]): rows that entered the results
+     - modified (List[dict]): rows still in the results whose data changed
+     - removed (List[dict]): rows that left the results (as they were last seen)
+    """
+    added: List[dict] = dc_field(default_factory=list)
+    modified: List[dict] = dc_field(default_factory=list)
+    removed: List[dict] = dc_field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.added or self.modified or self.removed)
+
+
+class _Binding:
+    """The snapshot listeners of one state's steps on one of its collections"""
+
+    def __init__(self, steps: List[Step]):
+        self.collection = steps[0].collection
+        self.steps = steps
+        self.predicates = [compile_filters(step.residual) for step in steps]
+        self.matches = [{} for _ in steps]  # per step, (state, document id) -> row it matches
+        self.ready = set()  # steps whose first snapshot arrived
+        self.watches = []
+
+    def row(self, key) -> Optional[dict]:
+        """The row of a document while any step (OR branch, IN chunk) matches it"""
+        return next((m[key] for m in self.matches if key in m), None)
+
+    def rows(self) -> dict:
+        rows = {}
+        for matches in self.matches:
+            rows.update(matches)
+        return rows
+
+    def unsubscribe(self):
+        for watch in self.watches:
+            watch.unsubscribe()
+
+
+class Subscription:
+    """
+    A live query started by subscribe. Every step of the plan gets a Firestore
+    snapshot listener, so Firestore only sends the documents that changed;
+    the current results are kept in memory and the callback receives a Delta
+    of the rows that were added, modified or removed. The first Delta holds
+    the initial results: it is only sent once every listener (OR branch, IN
+    chunk, state) delivered its first snapshot.
+
+    The pointer document of every state is watched too: when admin.py
+    switches a state to a new version, the state's listeners move to the new
+    collection and, once its first snapshots arrived, the callback receives
+    the difference between the old and new results (towns are matched on
+    town_id and town_name, since document ids differ between versions).
+    """
+
+    def __init__(self, db, plan: QueryPlan, callback: Callable[[Delta], None]):
+        if plan.filters[0][1].op == "OF" or _is_value_plan(plan):
+            raise ValueError("Only queries returning towns can be watched (not OF or town_name ==)")
+        self.plan = plan
+        self._db = db
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._rows = {}  # (state, document id) -> row, before ORDER BY / LIMIT
+        self._window = {}  # the rows currently reported, after ORDER BY / LIMIT, by town
+        self._started = False  # whether the initial results were sent
+        # listeners are not limited: client-side filters may drop documents
+        steps = [dc_replace(step, limit=None, stop_after=None)
+                 for step in _document_steps(resolve_states(db, plan.scope), plan)]
+        steps = _bind_collections(db, steps)
+        if any(step.packed for step in steps):
+            raise ValueError("Packed collections never change, so they cannot be watched")
+        self._templates = {}  # state -> its steps, to bind to a new version
+        for step in steps:
+            self._templates.setdefault(step.state, []).append(step)
+        self._bindings = {}  # state -> the binding whose rows are reported
+        self._pending = {}  # state -> the binding of a new version, until its first snapshots
+        for state, state_steps in self._templates.items():
+            self._bindings[state] = _Binding(state_steps)
+            self._attach(self._bindings[state])
+        pointers = db.collection(POINTER_COLLECTION)
+        self._pointer_watches = [pointers.document(state).on_snapshot(self._pointer_listener(state))
+                                 for state in self._templates]
+
+    @property
+    def results(self) -> List[dict]:
+        """The current result rows"""
+        with self._lock:
+            return _order_and_limit(list(self._rows.values()), self.plan)
+
+    def unsubscribe(self):
+        """Stops every snapshot listener"""
+        for watch in self._pointer_watches:
+            watch.unsubscribe()
+        with self._lock:
+            bindings = list(self._bindings.values()) + list(self._pending.values())
+        for binding in bindings:
+            binding.unsubscribe()
+
+    def _attach(self, binding: _Binding):
+        """Starts the listeners of a binding, which must be registered already
+        since they can fire while being attached"""
+        binding.watches = [step.query(self._db).on_snapshot(self._listener(binding, i))
+                           for i, step in enumerate(binding.steps)]
+
+    def _listener(self, binding: _Binding, i: int):
+        def on_snapshot(docs, changes, read_time):
+            self._apply(binding, i, changes)
+        return on_snapshot
+
+    def _pointer_listener(self, state: str):
+        def on_snapshot(docs, changes, read_time):
+            snapshot = docs[0] if docs else None
+            data = snapshot.to_dict() if snapshot is not None and snapshot.exists else None
+            collection = data["collection"] if data and data.get("collection") else collection_name(state)
+            layout = data.get("layout", DOCUMENTS_LAYOUT) if data else DOCUMENTS_LAYOUT
+            self._switch(state, collection, layout)
+        return on_snapshot
+
+    def _switch(self, state: str, collection: str, layout: str):
+        """Starts listening to the new version of a state"""
+        with self._lock:
+            pending = self._pending.get(state)
+            if collection == (pending or self._bindings[state]).collection:
+                return
+            if layout == PACKED_LAYOUT:
+                # packed versions cannot be watched, keep following the last watchable one
+                return
+            with _pointer_lock:
+                _pointer_cache.get(self._db, {}).pop(state, None)
+            stale = self._pending.pop(state, None)
+        if stale is not None:
+            stale.unsubscribe()
+        binding = _Binding([dc_replace(step, collection=collection) for step in self._templates[state]])
+        with self._lock:
+            self._pending[state] = binding
+        self._attach(binding)
+
+    def _apply(self, binding: _Binding, i: int, changes):
+        state = binding.steps[i].state
+        with self._lock:
+            touched = []
+            for change in changes:
+                doc = change.document
+                key = (state, doc.id)
+                data = doc.to_dict() if change.type.name != "REMOVED" else None
+                if data is not None and binding.predicates[i](data):
+                    binding.matches[i][key] = data | {"id": doc.id, "state": state}
+                else:
+                    binding.matches[i].pop(key, None)
+                touched.append(key)
+            binding.ready.add(i)
+
+            if binding is self._bindings.get(state):
+                delta = Delta()
+                for key in dict.fromkeys(touched):
+                    before = self._rows.get(key)
+                    after = binding.row(key)
+                    if after is None:
+                        if before is not None:
+                            del self._rows[key]
+                            delta.removed.append(before)
+                    elif before is None:
+                        self._rows[key] = after
+                        delta.added.append(after)
+                    elif before != after:
+                        self._rows[key] = after
+                        delta.modified.append(after)
+                old = None
+            elif binding is self._pending.get(state) and len(binding.ready) == len(binding.steps):
+                delta = self._replace_state(state, binding)
+                old = self._bindings[state]
+                self._bindings[state] = binding
+                del self._pending[state]
+            else:
+                return  # a stopped binding, or a new version still loading
+
+            ready = self._started or all(len(b.ready) == len(b.steps) for b in self._bindings.values())
+            if not ready:
+                delta = Delta()  # the initial results wait until every listener reported
+            elif not self._started:
+                self._started = True
+                delta = Delta(added=list(self._rows.values()))
+            if ready and self.plan.limit is not None:
+                # a change can push rows in or out of the limited window
+                delta = self._window_delta()
+        if old is not None:
+            old.unsubscribe()
+        if delta:
+            self._callback(delta)
+
+    def _replace_state(self, state: str, binding: _Binding) -> Delta:
+        """Swaps a state's rows for those of its new version and returns the difference"""
+        before = {_town_key(r): r for k, r in self._rows.items() if k[0] == state}
+        after = {_town_key(r): r for r in binding.rows().values()}
+        self._rows = {k: r for k, r in self._rows.items() if k[0] != state}
+        self._rows.update(binding.rows())
+        return Delta(added=[r for k, r in after.items() if k not in before],
+                     modified=[r for k, r in after.items() if k in before and not _same_town(before[k], r)],
+                     removed=[r for k, r in before.items() if k not in after])
+
+    def _window_delta(self) -> Delta:
+        window = {_town_key(r): r for r in _order_and_limit(list(self._rows.values()), self.plan)}
+        delta = Delta(added=[r for k, r in window.items() if k not in self._window],
+                      modified=[r for k, r in window.items()
+                                if k in self._window and not _same_town(self._window[k], r)],
+                      removed=[r for k, r in self._window.items() if k not in window])
+        self._window = window
+        return delta
+
+
+def _town_key(row: dict) -> tuple:
+    """Identifies a town across versions of a collection, whose document ids differ"""
+    return row["state"], row.get("town_id"), row.get("town_name")
+
+
+def _same_town(a: dict, b: dict) -> bool:
+    return {k: v for k, v in a.items() if k != "id"} == {k: v for k, v in b.items() if k != "id"}
+
+
+def subscribe(db, plan: QueryPlan, callback: Callable[[Delta], None]) -> Subscription:
+    """Starts a live query: callback receives a Delta every time towns enter,
+    change in or leave the results of plan. Call unsubscribe() on the
+    returned Subscription to stop."""
+    return Subscription(db, plan, callback)
+
+
+def _split_pushdown(branch: List[Filter]) -> Tuple[List[Filter], List[Filter]]:
+    """Splits an AND-chain into the filters sent to Firestore and the residual
+    filters evaluated in Python. Firestore only serves a query without a
+    composite index if it has equalities (any number of == plus one IN), or
+    inequalities on a single field (ranges, or one != / NOT IN). Equalities
+    win over ranges, and ranges over != / NOT IN, since that is usually the
+    order of selectivity."""
+    equalities = [f for f in branch if f.op == "=="]
+    ins = [f for f in branch if f.op == "IN"]
+    ranges = [f for f in branch if f.op in RANGE_OPS]
+    if equalities or ins:
+        pushed = equalities + ins[:1]
+    elif ranges:
+        pushed = [f for f in ranges if f.field == ranges[0].field]
+    else:
+        pushed = [branch[0]]
+    residual = [f for f in branch if f not in pushed]
+
+    # a NOT IN longer than Firestore allows sends its first values and checks all of them
+    for k, f in enumerate(pushed):
+        if f.op == "NOT IN" and len(f.value) > NOT_IN_QUERY_LIMIT:
+            pushed[k] = Filter(f.field, f.op, f.value[:NOT_IN_QUERY_LIMIT])
+            residual.append(f)
+    return pushed, residual
+
+
+def compile_filter(f: Filter) -> Callable[[dict], bool]:
+    """Compiles a Filter into a predicate over document dicts, with the same
+    semantics as the Firestore filter: values are coerced to the field's type
+    from FIELD_TYPES (ints and floats compare as numbers) and documents where
+    the field is missing or null never match"""
+    numeric = FIELD_TYPES.get(f.field) in (int, float)
+    coerce = float if numeric else str
+    if f.op in ("IN", "NOT IN"):
+        target = {coerce(v) for v in f.value}
+    else:
+        target = coerce(f.value)
+    test = PREDICATE_OPS[f.op]
+    name = f.field
+
+    def predicate(doc: dict) -> bool:
+        value = doc.get(name)
+        if value is None:
+            return False
+        try:
+            return test(coerce(value), target)
+        except (TypeError, ValueError):
+            return False
+
+    return predicate
+
+
+def compile_filters(filters: List[Filter]) -> Callable[[dict], bool]:
+    """Compiles an AND-chain of Filters into a single predicate"""
+    predicates = [compile_filter(f) for f in filters]
+    if not predicates:
+        return lambda doc: True
+    if len(predicates) == 1:
+        return predicates[0]
+    return lambda doc: all(p(doc) for p in predicates)
+
+
+def _field_filter(f: Filter) -> FieldFilter:
+    """Translates a Filter into a Firestore FieldFilter"""
+    return FieldFilter(f.field, FIRESTORE_OPS.get(f.op, f.op), f.value)
+
+
+def _chunk_in(f: Filter) -> List[Filter]:
+    """Splits an IN filter with more values than Firestore accepts into several
+    filters; their queries are run in parallel and their results unioned"""
+    if f.op != "IN" or len(f.value) <= IN_QUERY_LIMIT:
+        return [f]
+    return [Filter(f.field, f.op, f.value[i:i + IN_QUERY_LIMIT])
+            for i in range(0, len(f.value), IN_QUERY_LIMIT)]
@@ -1,5 +1,19 @@
-from query_engine import run_fn, Filter, QueryPlan
-from query import ensure_firestore, format_results
+import query_engine
+from query_engine import (run_fn, run_many, lookup_fn, explain_fn, subscribe, build_steps, active_collections,
+                          resolve_states, _packed_step, _packed_rows, Filter, QueryPlan, Step,
+                          POINTER_COLLECTION, PACKED_LAYOUT)
+from query import ensure_firestore, format_results, format_table
+from export import export_fn
+from admin import pack_towns
+from local_db import LocalFirestore
+from models import Town
+import csv
+import gc
+import json
+import os
+import tempfile
+import threading
+import time
 
 '''
 test_one ensures that the query "population == 0" returns three towns:
@@ -79,9 +93,353 @@ def test_five():
         return
     print('FAILED TEST FIVE')
 
+'''
+test_six checks that a multi-state query ordered by population with a limit
+returns at most that many towns, largest first
+'''
+def test_six():
+    db = ensure_firestore()
+    filters = [("", Filter(field="population", op=">", value=5000))]
+    plan = QueryPlan(filters=filters, scope=["VT", "NH"], order_by=("population", "DESC"), limit=3)
+    result = run_fn(db, plan)
+    populations = [r["population"] for r in result]
+    if len(result) <= 3 and populations == sorted(populations, reverse=True):
+        print("PASSED TEST SIX")
+        return
+    print("FAILED TEST SIX")
+
+'''
+test_seven checks that a bulk lookup of altitude and population returns one row
+for Cambridge and two for Barre (city and town), and skips unknown towns
+'''
+def test_seven():
+    db = ensure_firestore()
+    result = lookup_fn(db, ["Cambridge", "Barre", "Buel's Gore"], ["altitude", "population"])
+    names = [r["town_name"] for r in result]
+    if names == ["Cambridge", "Barre", "Barre"] and result[0]["population"] == 3186:
+        print("PASSED TEST SEVEN")
+        return
+    print("FAILED TEST SEVEN")
+
+'''
+test_eight checks that "county IN (Essex, Orleans)" returns only towns of those
+two counties, and the same towns as the equivalent OR query
+'''
+def test_eight():
+    db = ensure_firestore()
+    in_plan = QueryPlan(filters=[("", Filter(field="county", op="IN", value=["Essex", "Orleans"]))])
+    or_plan = QueryPlan(filters=[("", Filter(field="county", op="==", value="Essex")),
+                                 ("OR", Filter(field="county", op="==", value="Orleans"))])
+    in_result = run_fn(db, in_plan)
+    or_result = run_fn(db, or_plan)
+    if (all(r["county"] in ("Essex", "Orleans") for r in in_result)
+            and {r["id"] for r in in_result} == {r["id"] for r in or_result}):
+        print("PASSED TEST EIGHT")
+        return
+    print("FAILED TEST EIGHT")
+
+'''
+test_nine checks that "population > 5000 and altitude < 500", which Firestore
+cannot serve without a composite index, returns only matching towns
+'''
+def test_nine():
+    db = ensure_firestore()
+    filters = [("", Filter(field="population", op=">", value=5000)),
+               ("AND", Filter(field="altitude", op="<", value=500))]
+    plan = QueryPlan(filters=filters)
+    result = run_fn(db, plan)
+    if result and all(r["population"] > 5000 and r["altitude"] < 500 for r in result):
+        print("PASSED TEST NINE")
+        return
+    print("FAILED TEST NINE")
+
+'''
+test_ten checks that EXPLAIN reports the full scan of an OF query, and that
+EXPLAIN ANALYZE runs it and returns one row
+'''
+def test_ten():
+    db = ensure_firestore()
+    plan = QueryPlan(filters=[("", Filter(field="population", op="OF", value="Cambridge"))])
+    explained = explain_fn(db, plan)
+    analyzed = explain_fn(db, plan, analyze=True)
+    # the active collection may be a versioned one (Vermont_Municipalities_vN)
+    if (explained[1].startswith("1. full scan Vermont_Municipalities")
+            and analyzed[-1].endswith("1 rows returned")):
+        print("PASSED TEST TEN")
+        return
+    print("FAILED TEST TEN")
+
+'''
+test_eleven checks that exporting "county == Essex" to CSV writes one row per
+town run_fn returns, with every field of the model
+'''
+def test_eleven():
+    db = ensure_firestore()
+    plan = QueryPlan(filters=[("", Filter(field="county", op="==", value="Essex"))])
+    path = os.path.join(tempfile.mkdtemp(), "essex.csv")
+    count = export_fn(db, plan, path)
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    if (count == len(rows) == len(run_fn(db, plan))
+            and all(r["county"] == "Essex" and "altitude" in r for r in rows)):
+        print("PASSED TEST ELEVEN")
+        return
+    print("FAILED TEST ELEVEN")
+
+'''
+test_twelve checks that subscribing to "population > 10000" first delivers the
+same towns run_fn returns, as added rows
+'''
+def test_twelve():
+    db = ensure_firestore()
+    plan = QueryPlan(filters=[("", Filter(field="population", op=">", value=10000))])
+    first = threading.Event()
+    deltas = []
+
+    def callback(delta):
+        deltas.append(delta)
+        first.set()
+
+    subscription = subscribe(db, plan, callback)
+    first.wait(timeout=10)
+    subscription.unsubscribe()
+    expected = {r["id"] for r in run_fn(db, plan)}
+    if deltas and {r["id"] for r in deltas[0].added} == expected == {r["id"] for r in subscription.results}:
+        print("PASSED TEST TWELVE")
+        return
+    print("FAILED TEST TWELVE")
+
+'''
+test_thirteen checks that run_many returns the same results as running every
+plan on its own, for a batch of OF lookups and a regular query
+'''
+def test_thirteen():
+    db = ensure_firestore()
+    plans = [QueryPlan(filters=[("", Filter(field="population", op="OF", value=town))])
+             for town in ("Burlington", "Stowe", "Cambridge")]
+    plans.append(QueryPlan(filters=[("", Filter(field="county", op="==", value="Essex"))]))
+    if run_many(db, plans) == [run_fn(db, plan) for plan in plans]:
+        print("PASSED TEST THIRTEEN")
+        return
+    print("FAILED TEST THIRTEEN")
+
+'''
+test_fourteen checks that collections resolve through the pointer documents
+of Active_Collections on an in-process database: the unversioned collection
+without a pointer, the cached answer until POINTER_TTL expires, then the
+versioned collection (also for IN ALL STATES), and that the cached pointers
+go away with their client
+'''
+def test_fourteen():
+    db = LocalFirestore.from_json("Vermont_Muni.json")
+    plan = QueryPlan(filters=[("", Filter(field="county", op="==", value="Essex"))], scope=["ALL"])
+    ttl = query_engine.POINTER_TTL
+    query_engine.POINTER_TTL = 0.2
+    try:
+        before = run_fn(db, plan)
+        without_pointer = active_collections(db, ["vt"])
+
+        # load version 3 next to the base collection and point VT at it
+        for doc_id, data in db.documents("Vermont_Municipalities").items():
+            db.collection("Vermont_Municipalities_v3").document(doc_id).set(data)
+        db.collection(POINTER_COLLECTION).document("VT").set({"collection": "Vermont_Municipalities_v3", "version": 3})
+        reads = db.docs_read
+        cached = active_collections(db, ["VT"])
+        cached_reads = db.docs_read - reads
+
+        time.sleep(0.25)
+        refreshed = active_collections(db, ["VT"])
+        for doc_id in list(db.documents("Vermont_Municipalities")):
+            db.collection("Vermont_Municipalities").document(doc_id).delete()
+        states = resolve_states(db, ["ALL"])
+        after = run_fn(db, plan)
+
+        # a new client never sees the pointers cached for one that is gone,
+        # even when it reuses its address
+        cached_clients = len(query_engine._pointer_cache)
+        del db
+        gc.collect()
+        fresh = []
+        for _ in range(20):
+            client = LocalFirestore.from_json("Vermont_Muni.json")
+            fresh.append(active_collections(client, ["VT"]) == {"VT": "Vermont_Municipalities"}
+                         and len(run_fn(client, plan)) == len(before))
+            del client
+            gc.collect()
+        forgotten = all(fresh) and len(query_engine._pointer_cache) == cached_clients - 1
+    finally:
+        query_engine.POINTER_TTL = ttl
+    if (without_pointer == {"VT": "Vermont_Municipalities"}
+            and cached == {"VT": "Vermont_Municipalities"} and cached_reads == 0
+            and refreshed == {"VT": "Vermont_Municipalities_v3"}
+            and states == ["VT"] and after == before and len(after) > 0 and forgotten):
+        print("PASSED TEST FOURTEEN")
+        return
+    print("FAILED TEST FOURTEEN")
+
+'''
+test_fifteen checks the packed layout on an in-process database: queries,
+ORDER BY / LIMIT, OF lookups and run_many return the same towns as the
+one-document-per-town layout, the chunks are read once and cached until the
+pointer names another version (and only for the client that read them), and
+packed collections cannot be watched
+'''
+def test_fifteen():
+    with open("Vermont_Muni.json") as f:
+        towns = [Town.from_dict(item) for item in json.load(f)]
+    documents = LocalFirestore.from_json("Vermont_Muni.json")
+    packed = LocalFirestore()
+    for doc_id, data in pack_towns(towns, chunk_size=100).items():
+        packed.collection("Vermont_Municipalities_v1").document(doc_id).set(data)
+    packed.collection(POINTER_COLLECTION).document("VT").set(
+        {"collection": "Vermont_Municipalities_v1", "version": 1, "layout": PACKED_LAYOUT})
+
+    def towns_of(rows):
+        return sorted(({k: v for k, v in row.items() if k != "id"} for row in rows), key=lambda r: r["town_name"])
+
+    essex = QueryPlan(filters=[("", Filter(field="county", op="==", value="Essex"))])
+    plans = [essex,
+             QueryPlan(filters=[("", Filter(field="population", op=">", value=5000))],
+                       order_by=("population", "DESC"), limit=3),
+             QueryPlan(filters=[("", Filter(field="altitude", op="OF", value=["Burlington", "Stowe"]))])]
+    lookups = [QueryPlan(filters=[("", Filter(field="population", op="OF", value=town))])
+               for town in ("Burlington", "Stowe", "Cambridge")]
+
+    ttl = query_engine.POINTER_TTL
+    query_engine.POINTER_TTL = 0.2
+    try:
+        same = all(towns_of(run_fn(packed, plan)) == towns_of(run_fn(documents, plan)) for plan in plans[:2])
+        same = same and run_fn(packed, plans[2]) == run_fn(documents, plans[2])
+        same = same and run_many(packed, lookups) == run_many(documents, lookups)
+        ordered = [r["population"] for r in run_fn(packed, plans[1])] == \
+                  [r["population"] for r in run_fn(documents, plans[1])]
+
+        step = build_steps(packed, essex)[0]
+        cached = step.packed and _packed_rows(packed, step)[1] == 0
+
+        try:
+            subscribe(packed, essex, lambda delta: None)
+            refused = False
+        except ValueError:
+            refused = True
+
+        # version 2 drops one Essex town; readers move to it once the pointer expired
+        for doc_id, data in pack_towns([t for t in towns if t.town_name != "Lunenburg"]).items():
+            packed.collection("Vermont_Municipalities_v2").document(doc_id).set(data)
+        packed.collection(POINTER_COLLECTION).document("VT").set(
+            {"collection": "Vermont_Municipalities_v2", "version": 2, "layout": PACKED_LAYOUT})
+        time.sleep(0.25)
+        step = build_steps(packed, essex)[0]
+        rows, reads = _packed_rows(packed, step)
+        reloaded = (step.collection == "Vermont_Municipalities_v2" and reads == 2
+                    and {r["town_name"] for r in run_fn(packed, essex)}
+                    == {r["town_name"] for r in run_fn(documents, essex)} - {"Lunenburg"})
+    finally:
+        query_engine.POINTER_TTL = ttl
+
+    # a new client whose pointer names a collection of the same name reads
+    # its own chunks, not the rows cached for a client that is gone
+    cached_clients = len(query_engine._packed_cache), len(query_engine._packed_state_locks)
+    del packed
+    gc.collect()
+    fresh = []
+    for _ in range(20):
+        client = LocalFirestore()
+        for doc_id, data in pack_towns([t for t in towns if t.county == "Essex"]).items():
+            client.collection("Vermont_Municipalities_v2").document(doc_id).set(data)
+        client.collection(POINTER_COLLECTION).document("VT").set(
+            {"collection": "Vermont_Municipalities_v2", "version": 2, "layout": PACKED_LAYOUT})
+        orleans = QueryPlan(filters=[("", Filter(field="county", op="==", value="Orleans"))])
+        fresh.append(run_fn(client, orleans) == [] and len(run_fn(client, essex)) == len(run_fn(documents, essex)))
+        del client
+        gc.collect()
+    forgotten = all(fresh) and (len(query_engine._packed_cache), len(query_engine._packed_state_locks)) \
+        == (cached_clients[0] - 1, cached_clients[1] - 1)
+
+    limited = _packed_step(Step("VT", filters=[Filter("county", "==", "Essex")], limit=3))
+    ordered_step = _packed_step(Step("VT", order_by=("population", "DESC"), limit=3))
+    pushed_down = (limited.filters == [] and limited.residual == [Filter("county", "==", "Essex")]
+                   and limited.stop_after == 3 and ordered_step.stop_after is None and ordered_step.order_by is None)
+    if same and ordered and cached and refused and reloaded and pushed_down and forgotten:
+        print("PASSED TEST FIFTEEN")
+        return
+    print("FAILED TEST FIFTEEN")
+
+'''
+test_sixteen checks on an in-process database that bulk lookups match town
+names case-insensitively like OF, and that asking for town_name does not
+duplicate its column or its projection
+'''
+def test_sixteen():
+    db = LocalFirestore.from_json("Vermont_Muni.json")
+    lower = lookup_fn(db, ["burlington", "SOUTH burlington", "Burlington"], ["altitude"])
+    exact = lookup_fn(db, ["Burlington", "South Burlington"], ["altitude"])
+    batched = run_many(db, [QueryPlan(filters=[("", Filter(field="altitude", op="OF", value=["stowe", "barre"]))],
+                                      fields=["altitude"])])[0]
+    plan = QueryPlan(filters=[("", Filter(field="town_name", op="OF", value=["Stowe", "Barre"]))],
+                     fields=["town_name", "county"])
+    header = format_table(run_fn(db, plan), plan.fields).splitlines()[0].split()
+    if (lower == exact and [r["town_name"] for r in exact] == ["Burlington", "South Burlington"]
+            and [r["town_name"] for r in batched] == ["Stowe", "Barre", "Barre"]
+            and build_steps(db, plan)[0].fields == ["town_name", "county"]
+            and header == ["town_name", "county"]):
+        print("PASSED TEST SIXTEEN")
+        return
+    print("FAILED TEST SIXTEEN")
+
+'''
+test_seventeen watches an OR query (one listener per branch) on an
+in-process database: the initial results arrive as a single Delta, also
+with a LIMIT, and later writes arrive as added, modified and removed towns
+until unsubscribe
+'''
+def test_seventeen():
+    db = LocalFirestore.from_json("Vermont_Muni.json")
+    plan = QueryPlan(filters=[("", Filter(field="county", op="==", value="Essex")),
+                              ("OR", Filter(field="county", op="==", value="Orleans"))])
+    limited = QueryPlan(filters=plan.filters, order_by=("population", "DESC"), limit=3)
+    expected = {r["id"] for r in run_fn(db, plan)}
+    deltas, limited_deltas = [], []
+    subscription = subscribe(db, plan, deltas.append)
+    limited_subscription = subscribe(db, limited, limited_deltas.append)
+    initial = (len(deltas) == 1 and {r["id"] for r in deltas[0].added} == expected
+               and len(limited_deltas) == 1
+               and [r["id"] for r in limited_deltas[0].added] == [r["id"] for r in run_fn(db, limited)])
+
+    towns = db.collection("Vermont_Municipalities")
+    essex = next(r for r in run_fn(db, plan) if r["county"] == "Essex")
+    towns.document(essex["id"]).set({k: v for k, v in essex.items() if k not in ("id", "state")} | {"population": 1})
+    moved = next(r for r in run_fn(db, plan) if r["county"] == "Orleans")
+    towns.document(moved["id"]).set({k: v for k, v in moved.items() if k not in ("id", "state")} | {"county": "Lamoille"})
+    towns.document("new_town").set({"town_name": "Newtown", "county": "Orleans", "population": 5})
+    subscription.unsubscribe()
+    limited_subscription.unsubscribe()
+    towns.document("other_town").set({"town_name": "Othertown", "county": "Essex", "population": 5})
+
+    changes = [([r["id"] for r in d.added], [r["id"] for r in d.modified], [r["id"] for r in d.removed])
+               for d in deltas[1:]]
+    if (initial and changes == [([], [essex["id"]], []), ([], [], [moved["id"]]), (["new_town"], [], [])]
+            and {r["id"] for r in subscription.results} == expected - {moved["id"]} | {"new_town"}
+            and not db._watches):
+        print("PASSED TEST SEVENTEEN")
+        return
+    print("FAILED TEST SEVENTEEN")
+
 if __name__ == "__main__":
     test_one()
     test_two()
     test_three()
     test_four()
-    test_five()
\ No newline at end of file
+    test_five()
+    test_six()
+    test_seven()
+    test_eight()
+    test_nine()
+    test_ten()
+    test_eleven()
+    test_twelve()
+    test_thirteen()
+    test_fourteen()
+    test_fifteen()
+    test_sixteen()
+    test_seventeen()